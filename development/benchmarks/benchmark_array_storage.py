@@ -0,0 +1,59 @@
+"""
+Compare storage formats of rendered arrays (see roosts.utils.array_util) by write time, read time, and disk size.
+Arrays are taken from previously rendered npz files, e.g.
+    python benchmark_array_storage.py --array_dir ../../roosts_data/arrays/2020/06/01/KDOX --num_scans 20
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from roosts.utils.array_util import ARRAY_FORMATS, RenderedScan, load_arrays, save_arrays
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--array_dir', type=str, required=True, help="directory with rendered npz files, searched recursively")
+parser.add_argument('--num_scans', type=int, default=20)
+parser.add_argument('--tmp_dir', type=str, default=None, help="where to write the benchmark files")
+args = parser.parse_args()
+
+# the channels the detector reads, and rho_hv 0.5 read for rain
+DETECTOR_CHANNELS = [("reflectivity", 0.5), ("reflectivity", 1.5), ("velocity", 0.5)]
+
+array_paths = sorted(glob.glob(os.path.join(args.array_dir, "**", "*.npz"), recursive=True))[:args.num_scans]
+assert len(array_paths) > 0, f"no npz files under {args.array_dir}"
+scans = []
+for path in array_paths:
+    scans.append(load_arrays(path))
+print(f"Loaded {len(scans)} scans from {args.array_dir}\n", flush=True)
+
+print(f"{'format':<16}{'dtype':<10}{'write s/scan':>14}{'full read s/scan':>18}"
+      f"{'channel read s/scan':>21}{'MB/scan':>10}")
+for array_format in ARRAY_FORMATS:
+    for dtype in [None, "float32", "float16"]:
+        out_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+
+        start = time.time()
+        paths = [save_arrays(os.path.join(out_dir, str(i)), arrays, array_format, dtype)
+                 for i, arrays in enumerate(scans)]
+        write_time = (time.time() - start) / len(scans)
+
+        start = time.time()
+        for path in paths:
+            _ = [np.array(array) for array in load_arrays(path).values()]
+        full_read_time = (time.time() - start) / len(scans)
+
+        start = time.time()
+        for path in paths:
+            with RenderedScan(path) as scan:  # npz decompresses the whole member, npy only maps it
+                _ = [np.array(scan.get(field, elev)) for field, elev in DETECTOR_CHANNELS]
+                if scan.has_dualpol:
+                    _ = np.array(scan.get("cross_correlation_ratio", 0.5))
+        channel_read_time = (time.time() - start) / len(scans)
+
+        size = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir)) / len(scans) / 2 ** 20
+        print(f"{array_format:<16}{str(dtype):<10}{write_time:>14.3f}{full_read_time:>18.3f}"
+              f"{channel_read_time:>21.3f}{size:>10.1f}", flush=True)
+        shutil.rmtree(out_dir)
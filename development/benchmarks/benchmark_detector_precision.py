@@ -0,0 +1,99 @@
+"""
+Compare the speed of the detector at each precision and the drift of its detections from fp32, e.g.
+    python benchmark_detector_precision.py --model_version v3 --quantized_model ../../checkpoints/v3_int8.pth \
+        --array_dirs ../../roosts_data/arrays/2021/07/03/KDOX ../../roosts_data/arrays/2021/07/04/KTLX
+Use station-days other than the ones the int8 model was calibrated on.
+Each fp32 detection is matched to the closest detection of the same scan at the other precision;
+it counts as unmatched if no detection is centered within --match_dist pixels.
+"""
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import torch
+
+from roosts.detection.detector import Detector
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_version', type=str, default="v3")
+parser.add_argument('--array_dirs', type=str, nargs="+", required=True,
+                    help="directories of rendered scans, one per station-day")
+parser.add_argument('--precisions', type=str, nargs="+", default=["fp32", "bf16", "int8"])
+parser.add_argument('--quantized_model', type=str, default=None, help="int8 weights from tools/calibrate_detector.py")
+parser.add_argument('--min_score', type=float, default=0.5, help="only compare fp32 detections above this score")
+parser.add_argument('--match_dist', type=float, default=5., help="in pixels")
+args = parser.parse_args()
+
+if args.model_version == "v2":
+    ckpt_path = f"{here}/../../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+elif args.model_version == "v3":
+    ckpt_path = f"{here}/../../checkpoints/v3.pth"
+
+DET_CFG = {
+    "ckpt_path":        ckpt_path,
+    "imsize":           1100 if args.model_version == "v3" else 1200,
+    "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                         [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                         [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                         [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                         [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+    "nms_thresh":       0.3,
+    "score_thresh":     0.05,
+    "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+    "use_gpu":          False,
+    "version":          args.model_version,
+}
+
+array_files_by_day = []
+for array_dir in args.array_dirs:
+    array_files = sorted(glob.glob(os.path.join(array_dir, "*.np[yz]")))
+    array_files_by_day.append([f for f in array_files if not f.endswith(".dualpol.npy")])
+num_scans = sum(len(files) for files in array_files_by_day)
+print(f"{num_scans} scans, torch.get_num_threads: {torch.get_num_threads()}")
+
+
+def run(precision):
+    detector = Detector(**DET_CFG, precision=precision, quantized_model_path=args.quantized_model)
+    start_time = time.time()
+    detections = [det for array_files in array_files_by_day for det in detector.run(array_files)]
+    return detections, num_scans / (time.time() - start_time)
+
+
+def drift(reference, detections):
+    """ |score difference|, center shift and |radius difference| of matched reference detections, # unmatched """
+    score_diffs, center_shifts, radius_diffs, unmatched = [], [], [], 0
+    for det in reference:
+        if det["det_score"] < args.min_score:
+            continue
+        candidates = [d for d in detections if d["scanname"] == det["scanname"]]
+        if len(candidates) > 0:
+            dists = [np.linalg.norm(d["im_bbox"][:2] - det["im_bbox"][:2]) for d in candidates]
+            match = candidates[int(np.argmin(dists))]
+        if len(candidates) == 0 or min(dists) > args.match_dist:
+            unmatched += 1
+            continue
+        score_diffs.append(abs(match["det_score"] - det["det_score"]))
+        center_shifts.append(min(dists))
+        radius_diffs.append(abs(match["im_bbox"][2] - det["im_bbox"][2]))
+    return score_diffs, center_shifts, radius_diffs, unmatched
+
+
+reference, reference_speed = run("fp32")
+print(f"{'precision':>9} {'scans/s':>8} {'dets':>6} {'unmatched':>9} "
+      f"{'score mean/max':>15} {'center mean/max':>16} {'radius mean/max':>16}")
+for precision in args.precisions:
+    if precision == "fp32":
+        detections, speed = reference, reference_speed
+    else:
+        detections, speed = run(precision)
+    score_diffs, center_shifts, radius_diffs, unmatched = drift(reference, detections)
+    stats = [
+        f"{np.mean(diffs):.4f}/{np.max(diffs):.4f}" if len(diffs) > 0 else "-"
+        for diffs in [score_diffs, center_shifts, radius_diffs]
+    ]
+    print(f"{precision:>9} {speed:>8.3f} {len(detections):>6} {unmatched:>9} "
+          f"{stats[0]:>15} {stats[1]:>16} {stats[2]:>16}")
@@ -0,0 +1,88 @@
+"""
+Sweep torch intra-op and inter-op thread counts of the detector on a fixed set of rendered scans
+and report the fastest setting for this host, e.g.
+    python benchmark_detector_threads.py --model_version v3 \
+        --array_dir ../../roosts_data/arrays/2021/07/01/KDOX --num_scans 10
+Each setting runs in a fresh process, since inter-op threads can only be set once per process.
+The first scan of each setting is a warm-up and not timed.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_version', type=str, default="v3")
+parser.add_argument('--array_dir', type=str, required=True, help="directory of rendered scans of a station-day")
+parser.add_argument('--num_scans', type=int, default=10)
+parser.add_argument('--threads', type=int, nargs="+", default=None,
+                    help="intra-op thread counts to try, by default powers of 2 up to the number of cpus")
+parser.add_argument('--interop_threads', type=int, nargs="+", default=[1, 2])
+parser.add_argument('--cpu_affinity', type=str, default=None, help="pin to these cpus, e.g. 0-6")
+args = parser.parse_args()
+
+
+def get_det_cfg(model_version):
+    if model_version == "v2":
+        ckpt_path = f"{here}/../../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+    elif model_version == "v3":
+        ckpt_path = f"{here}/../../checkpoints/v3.pth"
+    return {
+        "ckpt_path":        ckpt_path,
+        "imsize":           1100 if model_version == "v3" else 1200,
+        "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                             [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                             [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                             [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                             [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+        "nms_thresh":       0.3,
+        "score_thresh":     0.05,
+        "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+        "use_gpu":          False,
+        "version":          model_version,
+    }
+
+
+def time_setting(model_version, array_files, num_threads, num_interop_threads, cpu_affinity):
+    """ Seconds per scan of the detector with a thread setting, run in a fresh process """
+    from roosts.detection.detector import Detector
+    detector = Detector(
+        **get_det_cfg(model_version),
+        num_threads=num_threads, num_interop_threads=num_interop_threads, cpu_affinity=cpu_affinity,
+    )
+    detector.run(array_files[:1])
+    start_time = time.time()
+    detector.run(array_files)
+    return (time.time() - start_time) / len(array_files)
+
+
+if __name__ == "__main__":
+    from roosts.utils.cpu_util import parse_cpu_list
+
+    cpu_affinity = parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None
+    num_cpus = len(cpu_affinity) if cpu_affinity else len(os.sched_getaffinity(0))
+    threads = args.threads or sorted(set([2 ** k for k in range(num_cpus.bit_length()) if 2 ** k <= num_cpus] + [num_cpus]))
+
+    array_files = sorted(glob.glob(os.path.join(args.array_dir, "*.np[yz]")))
+    array_files = [f for f in array_files if not f.endswith(".dualpol.npy")][:args.num_scans]
+    print(f"{len(array_files)} scans, {num_cpus} cpus")
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for num_interop_threads in args.interop_threads:
+        for num_threads in threads:
+            with context.Pool(1) as pool:
+                seconds = pool.apply(
+                    time_setting,
+                    (args.model_version, array_files, num_threads, num_interop_threads, cpu_affinity),
+                )
+            results[(num_threads, num_interop_threads)] = seconds
+            print(f"intra-op {num_threads:>3}, inter-op {num_interop_threads:>3}: {seconds:.3f}s per scan", flush=True)
+
+    (num_threads, num_interop_threads), seconds = min(results.items(), key=lambda item: item[1])
+    print(f"Best: --torch_threads {num_threads} --torch_interop_threads {num_interop_threads} "
+          f"({seconds:.3f}s per scan)")
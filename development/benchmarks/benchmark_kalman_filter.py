@@ -0,0 +1,109 @@
+"""
+Compare the batched Kalman filter of the tracker with the per-track formulation it replaced, kept below as
+reference_kalman_filter, on the tracks of a frame, for both parity and speed, e.g.
+    python benchmark_kalman_filter.py --num_tracks 1000 --matched_fraction 0.2
+Track states come from tracks predicted for a random number of frames, as tracks without matches are,
+so that covariances range from the initial one to the badly conditioned ones of long predicted tracks.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(here, "../../src"))
+from roosts.tracking.tracker import Tracker
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_tracks', type=int, default=1000)
+parser.add_argument('--matched_fraction', type=float, default=0.2)
+parser.add_argument('--max_predicted_frames', type=int, default=60)
+parser.add_argument('--repeats', type=int, default=20)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+
+def reference_kalman_filter(track_state, det_bbox, det_score, t, params):
+    """ Tracker._kalman_filter before it was batched: one track, with explicit matrix inverses """
+    Phi = np.array([[1,0,0,t,0,0],
+                    [0,1,0,0,t,0],
+                    [0,0,1,0,0,t],
+                    [0,0,0,1,0,0],
+                    [0,0,0,0,1,0],
+                    [0,0,0,0,0,1]])
+    Q = np.eye(6) * params['Q_multiplier']
+    H = np.eye(3, 6)
+
+    X_prev = track_state['mean']
+    P_prev = track_state['var']
+    X = Phi.dot(X_prev)
+    P_prior = Phi.dot(P_prev).dot(Phi.T) + Q
+
+    if det_bbox is None:
+        P = P_prior
+    else:
+        R = np.eye(3) + params['R_multiplier'] * np.eye(3) * (1 - det_score)
+        P_prior_inv = np.linalg.inv(P_prior)
+        R_inv = np.linalg.inv(R)
+        P = np.linalg.inv(P_prior_inv + H.T.dot(R_inv).dot(H))
+        K = P.dot(H.T).dot(R_inv)
+        X = X + K.dot(det_bbox - H.dot(X))
+
+    return {'mean': X, 'var': P}, H.dot(X)
+
+
+rng = np.random.default_rng(args.seed)
+tracker = Tracker()
+t = 7.
+
+states = []
+for _ in range(args.num_tracks):
+    state = {
+        "mean": np.array([*rng.uniform(0, 600, 2), rng.uniform(5, 50), *rng.normal(0, 1, 2), 1.59]),
+        "var": np.eye(6),
+    }
+    for _ in range(rng.integers(0, args.max_predicted_frames + 1)):
+        state, _ = reference_kalman_filter(state, None, None, t, tracker.params)
+    states.append(state)
+matched = np.flatnonzero(rng.random(args.num_tracks) < args.matched_fraction)
+det_bboxes = np.array([states[i]["mean"][:3] + rng.normal(0, 3, 3) for i in matched], dtype=np.float32)
+det_scores = rng.uniform(0.05, 1, len(matched)).astype(np.float32)
+
+
+def run_reference():
+    outputs = []
+    matches = dict(zip(matched, range(len(matched))))
+    for track_idx, state in enumerate(states):
+        if track_idx in matches:
+            k = matches[track_idx]
+            outputs.append(reference_kalman_filter(state, det_bboxes[k], det_scores[k], t, tracker.params))
+        else:
+            outputs.append(reference_kalman_filter(state, None, None, t, tracker.params))
+    return outputs
+
+
+def run_batched():
+    means = np.array([state["mean"] for state in states])
+    variances = np.array([state["var"] for state in states])
+    return tracker._kalman_filter(means, variances, matched, det_bboxes, det_scores, t)
+
+
+expected = run_reference()
+means, variances, bboxes = run_batched()
+mean_error = max(np.abs(means[i] - state["mean"]).max() for i, (state, _) in enumerate(expected))
+var_error = max(
+    np.abs(variances[i] - state["var"]).max() / np.abs(state["var"]).max() for i, (state, _) in enumerate(expected)
+)
+bbox_error = max(np.abs(bboxes[i] - bbox).max() for i, (_, bbox) in enumerate(expected))
+print(f"{args.num_tracks} tracks, {len(matched)} matched")
+print(f"max abs difference of means {mean_error:.1e}, of bboxes {bbox_error:.1e}")
+print(f"max relative difference of covariances {var_error:.1e}")
+
+for name, fn in [("per track", run_reference), ("batched", run_batched)]:
+    start_time = time.perf_counter()
+    for _ in range(args.repeats):
+        fn()
+    print(f"{name}: {(time.perf_counter() - start_time) / args.repeats * 1000:.2f} ms per frame")
@@ -0,0 +1,81 @@
+"""
+Check that a detector exported by tools/export_detector.py gives the same detections as the eager detector
+on rendered scans, and compare their speed on CPU, e.g.
+    python check_exported_detector_parity.py --model_version v3 --exported_model ../../checkpoints/v3.ts \
+        --array_dir ../../roosts_data/arrays/2021/07/01/KDOX --num_scans 20
+"""
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+import torch
+
+from roosts.detection.detector import Detector
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_version', type=str, default="v3")
+parser.add_argument('--exported_model', type=str, required=True)
+parser.add_argument('--array_dir', type=str, required=True, help="directory of rendered scans of a station-day")
+parser.add_argument('--num_scans', type=int, default=20)
+parser.add_argument('--atol', type=float, default=1e-2, help="tolerance on box coordinates in pixels and on scores")
+args = parser.parse_args()
+
+if args.model_version == "v2":
+    ckpt_path = f"{here}/../../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+elif args.model_version == "v3":
+    ckpt_path = f"{here}/../../checkpoints/v3.pth"
+
+DET_CFG = {
+    "ckpt_path":        ckpt_path,
+    "imsize":           1100 if args.model_version == "v3" else 1200,
+    "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                         [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                         [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                         [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                         [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+    "nms_thresh":       0.3,
+    "score_thresh":     0.05,
+    "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+    "use_gpu":          False,
+    "version":          args.model_version,
+}
+
+array_files = sorted(glob.glob(os.path.join(args.array_dir, "*.np[yz]")))
+array_files = [f for f in array_files if not f.endswith(".dualpol.npy")][:args.num_scans]
+print(f"{len(array_files)} scans, torch.get_num_threads: {torch.get_num_threads()}")
+
+
+def run(detector):
+    start_time = time.time()
+    detections = detector.run(array_files)
+    return detections, (time.time() - start_time) / len(array_files)
+
+
+eager_detections, eager_time = run(Detector(**DET_CFG))
+exported_detections, exported_time = run(Detector(**DET_CFG, exported_model_path=args.exported_model))
+
+print(f"eager:    {len(eager_detections)} detections, {eager_time:.3f}s per scan")
+print(f"exported: {len(exported_detections)} detections, {exported_time:.3f}s per scan")
+
+mismatches = 0
+for scanname in sorted(set(det["scanname"] for det in eager_detections + exported_detections)):
+    eager = [det for det in eager_detections if det["scanname"] == scanname]
+    exported = [det for det in exported_detections if det["scanname"] == scanname]
+    if len(eager) != len(exported):
+        print(f"{scanname}: {len(eager)} eager vs {len(exported)} exported detections")
+        mismatches += 1
+        continue
+    for det_a, det_b in zip(eager, exported):
+        if (
+            abs(det_a["det_score"] - det_b["det_score"]) > args.atol
+            or not np.allclose(det_a["im_bbox"], det_b["im_bbox"], atol=args.atol)
+        ):
+            print(f"{scanname}: {det_a['det_score']:.4f} {det_a['im_bbox']} vs "
+                  f"{det_b['det_score']:.4f} {det_b['im_bbox']}")
+            mismatches += 1
+
+print("PASSED" if mismatches == 0 else f"FAILED: {mismatches} mismatches")
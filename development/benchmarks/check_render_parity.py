@@ -0,0 +1,73 @@
+"""
+Check that combined rendering (Renderer(combined_rendering=True), e.g. demo.py --combined_rendering) gives the
+same arrays as radar2mat on downloaded scans, and compare their speed, e.g.
+    python check_render_parity.py --scan_dir ../../roosts_data/scans/2021/07/01/KDOX --num_scans 20
+Arrays are compared exactly, with NaNs at the same pixels, and a rendering that fails on one side must fail
+on the other. Combined rendering stays experimental until this passes on scans that cover
+    - split-cut VCPs (e.g. 212, 215), which have several sweeps at the same elevation, and SAILS/MESO-SAILS
+      scans, which repeat the lowest elevation;
+    - scans without dual-pol fields (before 2013), where the dualpol array fails to render on both sides;
+    - sweeps with duplicated azimuths, which radar2mat rejects.
+Pass several --scan_dir to cover them; each scan is reported with its VCP and the arrays rendered on each side.
+"""
+
+import argparse
+import glob
+import os
+import time
+import numpy as np
+from wsrlib import pyart
+
+from roosts.data.renderer import Renderer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--scan_dir', type=str, nargs='+', required=True,
+                    help="directories of downloaded scans, e.g. one per station-day")
+parser.add_argument('--num_scans', type=int, default=20, help="scans per directory")
+args = parser.parse_args()
+
+
+class _Logger:
+    def __init__(self, side):
+        self.side = side
+
+    def info(self, msg):
+        pass
+
+    def error(self, msg):
+        print(f"  {self.side}: {msg}", flush=True)
+
+
+scan_paths = []
+for scan_dir in args.scan_dir:
+    paths = sorted(p for p in glob.glob(os.path.join(scan_dir, "*")) if not p.endswith("_MDM"))
+    scan_paths.extend(paths[:args.num_scans])
+reference = Renderer(None, None, "", combined_rendering=False)
+combined = Renderer(None, None, "", combined_rendering=True)
+assert combined.combined_rendering, "the array and dualpol render configs do not share a nearest geometry"
+
+times = {"radar2mat": 0., "combined": 0.}
+num_different = 0
+for path in scan_paths:
+    scan = os.path.basename(path)
+    radar = pyart.io.read_nexrad_archive(path)
+    print(f"{scan}: VCP {radar.metadata.get('vcp_pattern')}, {radar.nsweeps} sweeps", flush=True)
+    start_time = time.perf_counter()
+    expected = reference.render_arrays(radar, scan, _Logger("radar2mat"))
+    times["radar2mat"] += time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    arrays = combined.render_arrays_combined(radar, scan, _Logger("combined"))
+    times["combined"] += time.perf_counter() - start_time
+    same = arrays.keys() == expected.keys()
+    if not same:
+        print(f"  rendered by radar2mat {sorted(expected)}, by combined {sorted(arrays)}", flush=True)
+    for name in sorted(arrays.keys() & expected.keys()):
+        if not np.array_equal(arrays[name], expected[name], equal_nan=True):
+            same = False
+            print(f"  {name} differs from radar2mat", flush=True)
+    if not same:
+        num_different += 1
+
+print(f"{len(scan_paths)} scans, {num_different} rendered differently")
+for name, elapsed in times.items():
+    print(f"{name}: {elapsed / max(1, len(scan_paths)):.3f}s per scan")
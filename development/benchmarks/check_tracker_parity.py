@@ -0,0 +1,221 @@
+"""
+Check that the tracker produces the same detections and tracks as the tracker before it was optimized,
+and compare their speed, e.g.
+    python check_tracker_parity.py
+    python check_tracker_parity.py --reference old_tracker.py --cache_dir ../../roosts_data/detection_cache/<hash>
+By default, the tracker runs on the station-days in tracker_fixtures/ (gzipped JSON) and its outputs are compared
+with the ones recorded there from the tracker before optimization. The fixtures are generated station-days of
+roost-like tracks with duplicated and missed detections, and clutter; they were recorded with
+    python check_tracker_parity.py --reference old_tracker.py --record --synthetic_days 3 --scans_per_day 24
+where old_tracker.py is src/roosts/tracking/tracker.py before the tracker was optimized.
+With --reference, any tracker.py file is run as the reference instead, on station-days read from a detection
+cache written by demo.py --detection_cache (--cache_dir) or generated (--synthetic_days).
+Associations, i.e. scan names, det_IDs, track_IDs, scores and flags, are compared exactly. Boxes and track
+states are compared with --rtol and --atol, since the batched Kalman filter rounds differently from the
+per-track one, by less than 1e-12 relative on these fixtures.
+"""
+
+import argparse
+import copy
+import glob
+import gzip
+import importlib.util
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+here = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(here, "../../src"))
+from roosts.tracking.tracker import Tracker
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--fixture_dir', type=str, default=os.path.join(here, "tracker_fixtures"))
+parser.add_argument('--reference', type=str, default=None,
+                    help="a tracker.py to compare with instead of the fixtures, e.g. saved from an older revision")
+parser.add_argument('--record', action='store_true',
+                    help="with --reference, write its inputs and outputs to --fixture_dir instead of comparing")
+parser.add_argument('--cache_dir', type=str, default=None,
+                    help="a config directory of the detection cache, i.e. {detection_cache_dir}/{config hash}")
+parser.add_argument('--synthetic_days', type=int, default=3, help="station-days to generate without --cache_dir")
+parser.add_argument('--scans_per_day', type=int, default=60)
+parser.add_argument('--dets_per_scan', type=int, default=10)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--rtol', type=float, default=1e-9, help="relative tolerance on boxes and track states")
+parser.add_argument('--atol', type=float, default=1e-9, help="absolute tolerance on boxes and track states")
+args = parser.parse_args()
+assert args.reference is not None or not args.record, "--record needs a --reference tracker"
+
+
+def load_reference_tracker(path):
+    spec = importlib.util.spec_from_file_location("reference_tracker", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Tracker
+
+
+def load_cached_days(cache_dir):
+    """ (scans, detections) of each station-day in the cache, with det_IDs assigned as by Detector.run """
+    days = []
+    for day_dir in sorted(glob.glob(os.path.join(cache_dir, "*", "*", "*", "*"))):
+        scans, detections = [], []
+        for path in sorted(glob.glob(os.path.join(day_dir, "*.json"))):
+            scanname = os.path.splitext(os.path.basename(path))[0]
+            with open(path) as f:
+                cached = json.load(f)
+            scans.append(scanname)
+            for det in cached["detections"]:
+                detections.append({
+                    "scanname":  scanname,
+                    "det_ID":    len(detections),
+                    "det_score": np.float32(det["det_score"]),
+                    "im_bbox":   np.array(det["im_bbox"], dtype=np.float32),
+                })
+        days.append((scans, detections))
+    return days
+
+
+def synthetic_day(rng, day_idx, num_scans, dets_per_scan):
+    """ A station-day of roosts expanding from the radar, each with duplicated detections, and clutter """
+    start = datetime(2021, 7, 1, 10, 0, 0) + timedelta(days=day_idx)
+    times = start + np.cumsum(rng.uniform(4, 10, num_scans)) * timedelta(minutes=1)
+    scans = [f"KDOX{t:%Y%m%d_%H%M%S}_V06" for t in times]
+    minutes = np.array([(t - times[0]).total_seconds() / 60 for t in times])
+
+    num_roosts = max(1, dets_per_scan // 4)
+    roosts = []
+    for _ in range(num_roosts):
+        first = rng.integers(0, num_scans - 1)
+        roosts.append({
+            "first": first,
+            "last": min(num_scans, first + rng.integers(3, 30)),
+            "center": rng.uniform(50, 550, 2),
+            "velocity": rng.normal(0, 1, 2),
+            "radius": rng.uniform(5, 20),
+            "expansion": rng.uniform(0.5, 2.5),
+            "duplicates": rng.integers(1, 4),
+        })
+
+    detections = []
+    for scan_idx, scanname in enumerate(scans):
+        boxes, scores = [], []
+        for roost in roosts:
+            if not roost["first"] <= scan_idx < roost["last"] or rng.random() < 0.1:  # missed detections
+                continue
+            dt = minutes[scan_idx] - minutes[roost["first"]]
+            center = roost["center"] + roost["velocity"] * dt
+            radius = roost["radius"] + roost["expansion"] * dt
+            for _ in range(roost["duplicates"]):
+                boxes.append([*(center + rng.normal(0, 2, 2)), radius * rng.uniform(0.9, 1.1)])
+                scores.append(rng.uniform(0.3, 1))
+        for _ in range(rng.poisson(max(1, dets_per_scan - len(boxes)))):  # clutter, e.g. rain
+            boxes.append([*rng.uniform(0, 600, 2), rng.uniform(5, 60)])
+            scores.append(rng.uniform(0.05, 0.5))
+        for box, score in zip(boxes, scores):
+            detections.append({
+                "scanname":  scanname,
+                "det_ID":    len(detections),
+                "det_score": np.float32(score),
+                "im_bbox":   np.array(box, dtype=np.float32),
+            })
+    return scans, detections
+
+
+def encode(value):
+    """ A JSON-serializable form of tracker inputs and outputs that decode restores with the same types """
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    elif isinstance(value, np.ndarray):
+        return {"ndarray": value.tolist(), "dtype": str(value.dtype)}
+    elif isinstance(value, np.generic):
+        return {"scalar": value.item(), "dtype": str(value.dtype)}
+    return value
+
+
+def decode(value):
+    if isinstance(value, dict):
+        if "ndarray" in value:
+            return np.array(value["ndarray"], dtype=value["dtype"])
+        elif "scalar" in value:
+            return np.dtype(value["dtype"]).type(value["scalar"])
+        return {key: decode(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+def assert_equal(a, b, path="outputs"):
+    if isinstance(a, dict):
+        assert isinstance(b, dict) and a.keys() == b.keys(), f"{path}: keys {list(a)} != {list(b)}"
+        for key in a:
+            assert_equal(a[key], b[key], f"{path}[{key!r}]")
+    elif isinstance(a, (list, tuple)):
+        assert isinstance(b, (list, tuple)) and len(a) == len(b), f"{path}: length {len(a)} != {len(b)}"
+        for idx, (x, y) in enumerate(zip(a, b)):
+            assert_equal(x, y, f"{path}[{idx}]")
+    elif isinstance(a, np.ndarray) and np.issubdtype(a.dtype, np.floating):
+        assert np.shape(a) == np.shape(b), f"{path}: shape {np.shape(a)} != {np.shape(b)}"
+        assert np.allclose(a, b, rtol=args.rtol, atol=args.atol), f"{path}: {a} != {b}"
+    else:
+        assert np.array_equal(a, b) if isinstance(a, np.ndarray) else a == b, f"{path}: {a} != {b}"
+
+
+def run(tracker, scans, detections):
+    scans, detections = list(scans), copy.deepcopy(detections)
+    start_time = time.perf_counter()
+    outputs = tracker.tracking(scans, detections)
+    return outputs, time.perf_counter() - start_time
+
+
+if args.reference is None:
+    days, expected_outputs = [], []
+    for path in sorted(glob.glob(os.path.join(args.fixture_dir, "*.json.gz"))):
+        with gzip.open(path, "rt") as f:
+            fixture = decode(json.load(f))
+        days.append((fixture["scans"], fixture["detections"]))
+        expected_outputs.append(fixture["outputs"])
+    assert len(days) > 0, f"no fixtures in {args.fixture_dir}"
+    reference_name = f"the fixtures in {args.fixture_dir}"
+else:
+    if args.cache_dir is not None:
+        days = load_cached_days(args.cache_dir)
+    else:
+        rng = np.random.default_rng(args.seed)
+        days = [synthetic_day(rng, i, args.scans_per_day, args.dets_per_scan) for i in range(args.synthetic_days)]
+    reference = load_reference_tracker(args.reference)()
+    reference_name = f"the tracker in {args.reference}"
+
+reference_time = tracker_time = 0.
+tracker = Tracker()
+for day_idx, (scans, detections) in enumerate(days):
+    if args.reference is None:
+        expected = expected_outputs[day_idx]
+    else:
+        expected, elapsed = run(reference, scans, detections)
+        reference_time += elapsed
+    if args.record:
+        os.makedirs(args.fixture_dir, exist_ok=True)
+        fixture = encode({"scans": scans, "detections": detections, "outputs": expected})
+        path = os.path.join(args.fixture_dir, f"day{day_idx}.json.gz")
+        with gzip.GzipFile(path, "wb", mtime=0) as f:  # same bytes when recorded again
+            f.write(json.dumps(fixture).encode())
+        continue
+    outputs, elapsed = run(tracker, scans, detections)
+    tracker_time += elapsed
+    assert_equal(outputs, expected)
+
+num_dets = sum(len(detections) for _, detections in days)
+if args.record:
+    print(f"Recorded {len(days)} station-days, {num_dets} detections to {args.fixture_dir}")
+else:
+    print(f"{len(days)} station-days, {num_dets} detections: outputs match {reference_name}")
+    if args.reference is None:
+        print(f"current {tracker_time:.2f}s")
+    else:
+        print(f"reference {reference_time:.2f}s, current {tracker_time:.2f}s, "
+              f"speedup {reference_time / tracker_time:.1f}x")
@@ -1,43 +1,133 @@
 import os
-from roosts.utils.s3_util import download_scan
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from roosts.utils.array_util import find_array_file
+from roosts.utils.s3_util import download_scan, get_s3_client_stats
 from tqdm import tqdm
 
 
 class Downloader:
 
-    """ 
+    """
         This class iteratively downloads the radar scans in a certain date range from a certain radar station
         in a daily basis. Station-day is the minimum unit of tracking roosts.
+        With num_workers > 1, scans of a station-day are downloaded concurrently by a bounded pool of threads.
     """
 
-    def __init__(self, download_dir, npz_dir, aws_access_key_id=None, aws_secret_access_key=None):
+    def __init__(
+            self,
+            download_dir,
+            npz_dir,
+            aws_access_key_id=None,
+            aws_secret_access_key=None,
+            num_workers=1,      # number of concurrent downloads, 1 means downloading scans one by one
+    ):
         self.download_dir = download_dir
         os.makedirs(self.download_dir, exist_ok=True)
         self.npz_dir = npz_dir
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self.num_workers = max(1, num_workers)
+
+    def _download_scan(self, key, logger):
+        """ Download a single scan, return whether the scan is available for rendering """
+
+        # skip if arrays are already rendered
+        if find_array_file(os.path.join(self.npz_dir, os.path.splitext(key)[0])) is not None:
+            return True
+
+        try:
+            download_scan(
+                key,
+                self.download_dir,
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+            )
+            logger.info('[Download Success] scan %s' % key.split("/")[-1])
+            return True
+        except Exception as ex:
+            logger.error('[Download Failure] scan %s - %s' % (key.split("/")[-1], str(ex)))
+            return False
 
     def download_scans(self, keys, logger):
         """ Download radar scans from AWS """
 
-        valid_keys = [] # list of the file path of downloaded scans
-        for key in tqdm(keys, desc="Downloading"):
-            # skip if an npz file is already rendered
-            if os.path.exists(os.path.join(self.npz_dir, f"{os.path.splitext(key)[0]}.npz")):
-                valid_keys.append(key)
-                continue
-
-            try:
-                download_scan(
-                    key,
-                    self.download_dir,
-                    aws_access_key_id=self.aws_access_key_id,
-                    aws_secret_access_key=self.aws_secret_access_key,
-                )
-                valid_keys.append(key)
-                logger.info('[Download Success] scan %s' % key.split("/")[-1])
-            except Exception as ex:
-                logger.error('[Download Failure] scan %s - %s' % (key.split("/")[-1], str(ex)))
-
-        return valid_keys
+        if self.num_workers == 1:
+            success = [self._download_scan(key, logger) for key in tqdm(keys, desc="Downloading")]
+        else:
+            success = [False] * len(keys)
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+                futures = {executor.submit(self._download_scan, key, logger): idx for idx, key in enumerate(keys)}
+                for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
+                    success[futures[future]] = future.result()
+
+        self._log_s3_client_stats(logger)
+
+        # list of the file path of downloaded scans,
+        # in the original order of keys so that downstream rendering and tracking are unaffected
+        return [key for key, ok in zip(keys, success) if ok]
+
+    def iter_download_scans(self, keys, logger, queue_size=None):
+        """
+            Download radar scans from AWS and yield (index in keys, key, success) as soon as each download completes,
+            so that a consumer (e.g. the renderer) can process scans while the rest are still being downloaded.
+            Downloaded-but-unconsumed scans are held in a bounded queue; downloads pause when the queue is full.
+        """
+
+        pending = queue.Queue()
+        for item in enumerate(keys):
+            pending.put(item)
+        done = queue.Queue(maxsize=queue_size or 2 * self.num_workers)
+        stop = threading.Event() # set when the consumer stops iterating, e.g. on an exception
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    done.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    idx, key = pending.get_nowait()
+                except queue.Empty:
+                    break
+                put((idx, key, self._download_scan(key, logger)))
+            put(None) # this worker is finished
+
+        num_workers = min(self.num_workers, len(keys))
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(num_workers)]
+        for thread in workers:
+            thread.start()
+
+        try:
+            finished = 0
+            while finished < num_workers:
+                item = done.get()
+                if item is None:
+                    finished += 1
+                else:
+                    yield item
+        finally:
+            # workers finish their current download and exit, nothing is left blocked on the queue
+            stop.set()
+            for thread in workers:
+                while thread.is_alive():
+                    try:
+                        done.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                    thread.join(timeout=0.1)
+
+        self._log_s3_client_stats(logger)
 
+    def _log_s3_client_stats(self, logger):
+        stats = get_s3_client_stats()
+        logger.info(
+            f'[S3 Client Pool] {stats["clients_created"]} clients created, '
+            f'{stats["sessions_saved"]} session setups and at least '
+            f'{stats["connections_saved"]} connection handshakes saved'
+        )
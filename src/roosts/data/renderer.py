@@ -1,8 +1,11 @@
 import os
-import numpy as np
 from wsrlib import pyart, radar2mat
 import logging
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from roosts.utils.array_util import find_array_file, save_arrays
+from roosts.utils.render_util import NearestMapping, get_geometry, is_shared_nearest_geometry
 import matplotlib.pyplot as plt
 import matplotlib.colors as pltc
 from matplotlib.image import imsave
@@ -74,6 +77,10 @@ class Renderer:
             ui_img_dir,
             array_render_config=ARRAY_RENDER_CONFIG,
             dualpol_render_config=DUALPOL_RENDER_CONFIG,
+            num_workers=1,      # number of processes rendering scans in parallel, 1 means rendering in this process
+            combined_rendering=False,   # experimental: one polar-to-Cartesian mapping per scan for both arrays
+            array_format="npz_compressed",  # storage format of rendered arrays, see roosts.utils.array_util
+            array_dtype=None,               # None, "float32" or "float16" to downcast rendered arrays
     ):
         self.download_dir = download_dir
         self.npz_dir = npz_dir
@@ -84,6 +91,40 @@ class Renderer:
 
         self.array_render_config = array_render_config
         self.dualpol_render_config = dualpol_render_config
+        self.num_workers = max(1, num_workers)
+        self.combined_rendering = combined_rendering and is_shared_nearest_geometry(
+            array_render_config, dualpol_render_config
+        )
+        self.array_format = array_format
+        self.array_dtype = array_dtype
+        self.executor = None # pool of rendering processes, created on first use and kept across station-days
+
+    def __getstate__(self):
+        # sent once to each rendering process, without the pool
+        state = self.__dict__.copy()
+        state["executor"] = None
+        return state
+
+    def _get_executor(self):
+        """
+            The pool of rendering processes. They are started with forkserver (spawn where unavailable) rather
+            than fork, since the parent may be running download threads holding locks, e.g. of boto3 connection
+            pools, which a forked child would inherit in a locked state. Each process receives this renderer once.
+        """
+        if self.executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.num_workers, mp_context=context,
+                initializer=_init_render_worker, initargs=(self,),
+            )
+        return self.executor
+
+    def close(self):
+        """ Shut down the rendering processes, if any """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
     def render(self, keys, logger, force_rendering=False):
         """
@@ -92,66 +133,145 @@ class Renderer:
             Radar scans are typically deleted after this.
         """
 
-        npz_files = [] # the list of arrays for the detector to load and process
-        scan_names = [] # the list of all scans for the tracker to know
-        img_files = [] # the list of dz05 images for visualization
-
-        for key in tqdm(keys, desc="Rendering"):
-            key_splits = key.split("/")
-            utc_year = key_splits[-5]
-            utc_month = key_splits[-4]
-            utc_date = key_splits[-3]
-            utc_station = key_splits[-2]
-            utc_date_station_prefix = os.path.join(utc_year, utc_month, utc_date, utc_station)
-            scan = os.path.splitext(key_splits[-1])[0]
-
-            npz_dir = os.path.join(self.npz_dir, utc_date_station_prefix)
-            dz05_imgdir = os.path.join(self.dz05_imgdir, utc_date_station_prefix)
-            vr05_imgdir = os.path.join(self.vr05_imgdir, utc_date_station_prefix)
-            os.makedirs(npz_dir, exist_ok=True)
-            os.makedirs(dz05_imgdir, exist_ok=True)
-            os.makedirs(vr05_imgdir, exist_ok=True)
-
-            npz_path = os.path.join(npz_dir, f"{scan}.npz")
-            dz05_path = os.path.join(dz05_imgdir, f"{scan}.jpg")
-
-            if os.path.exists(npz_path) and os.path.exists(dz05_path) and not force_rendering:
-                npz_files.append(npz_path)
-                scan_names.append(scan)
-                img_files.append(dz05_path)
-                continue
-
-            arrays = {}
-
-            try:
-                radar = pyart.io.read_nexrad_archive(os.path.join(self.download_dir, key))
-            except Exception as ex:
-                logger.error('[Scan Loading Failure] scan %s - %s' % (scan, str(ex)))
-                continue
-
-            try:
-                data, _, _, y, x = radar2mat(radar, **self.array_render_config)
-                logger.info('[Array Rendering Success] scan %s' % scan)
-                arrays["array"] = data
-            except Exception as ex:
-                logger.error('[Array Rendering Failure] scan %s - %s' % (scan, str(ex)))
-
-            try:
-                data, _, _, y, x = radar2mat(radar, **self.dualpol_render_config)
-                logger.info('[Dualpol Rendering Success] scan %s' % scan)
-                arrays["dualpol_array"] = data
-            except Exception as ex:
-                logger.error('[Dualpol Rendering Failure] scan %s - %s' % (scan, str(ex)))
-
-            if "array" in arrays:
-                np.savez_compressed(npz_path, **arrays)
-                self.render_img(arrays["array"], utc_date_station_prefix, scan) # render dz05 and vr05 as png for UI
-                npz_files.append(npz_path)
-                scan_names.append(scan)
-                img_files.append(dz05_path)
+        rendered = self.render_stream(enumerate(keys), logger, force_rendering=force_rendering, total=len(keys))
+        rendered = [rendered[idx] for idx in sorted(rendered)]
+
+        npz_files = [r[0] for r in rendered] # the list of arrays for the detector to load and process
+        scan_names = [r[1] for r in rendered] # the list of all scans for the tracker to know
+        img_files = [r[2] for r in rendered] # the list of dz05 images for visualization
 
         return npz_files, scan_names, img_files
 
+    def render_stream(self, indexed_keys, logger, force_rendering=False, total=None):
+        """
+            Render (index, key) pairs as they arrive, e.g. as soon as each scan is downloaded.
+            With num_workers > 1, scans are rendered by a pool of processes which write npz and jpg files
+            directly and only send paths and log messages back.
+            Return {index: (npz_path, scan_name, dz05_path)} for scans whose arrays are available.
+        """
+
+        rendered = {}
+        if self.num_workers == 1:
+            for idx, key in tqdm(indexed_keys, total=total, desc="Rendering"):
+                result = self.render_scan(key, logger, force_rendering=force_rendering)
+                if result is not None:
+                    rendered[idx] = result
+            return rendered
+
+        executor = self._get_executor()
+        futures = {
+            executor.submit(_render_scan_in_worker, key, force_rendering): idx
+            for idx, key in indexed_keys
+        }
+        try:
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering"):
+                result, records = future.result()
+                for level, msg in records:
+                    logger.log(level, msg)
+                if result is not None:
+                    rendered[futures[future]] = result
+        finally:
+            for future in futures:
+                future.cancel() # scans not started yet, if rendering was interrupted
+        return rendered
+
+    def render_scan(self, key, logger, force_rendering=False):
+        """
+            Render a single downloaded scan.
+            Return (array_path, scan_name, dz05_path) if the array is available, otherwise None.
+        """
+
+        key_splits = key.split("/")
+        utc_year = key_splits[-5]
+        utc_month = key_splits[-4]
+        utc_date = key_splits[-3]
+        utc_station = key_splits[-2]
+        utc_date_station_prefix = os.path.join(utc_year, utc_month, utc_date, utc_station)
+        scan = os.path.splitext(key_splits[-1])[0]
+
+        npz_dir = os.path.join(self.npz_dir, utc_date_station_prefix)
+        dz05_imgdir = os.path.join(self.dz05_imgdir, utc_date_station_prefix)
+        vr05_imgdir = os.path.join(self.vr05_imgdir, utc_date_station_prefix)
+        os.makedirs(npz_dir, exist_ok=True)
+        os.makedirs(dz05_imgdir, exist_ok=True)
+        os.makedirs(vr05_imgdir, exist_ok=True)
+
+        dz05_path = os.path.join(dz05_imgdir, f"{scan}.jpg")
+
+        # arrays rendered before in any storage format are reused
+        npz_path = find_array_file(os.path.join(npz_dir, scan))
+        if npz_path is not None and os.path.exists(dz05_path) and not force_rendering:
+            return npz_path, scan, dz05_path
+
+        try:
+            radar = pyart.io.read_nexrad_archive(os.path.join(self.download_dir, key))
+        except Exception as ex:
+            logger.error('[Scan Loading Failure] scan %s - %s' % (scan, str(ex)))
+            return None
+
+        if self.combined_rendering:
+            arrays = self.render_arrays_combined(radar, scan, logger)
+        else:
+            arrays = self.render_arrays(radar, scan, logger)
+
+        if "array" not in arrays:
+            return None
+
+        npz_path = save_arrays(os.path.join(npz_dir, scan), arrays, self.array_format, self.array_dtype)
+        self.render_img(arrays["array"], utc_date_station_prefix, scan) # render dz05 and vr05 as png for UI
+        return npz_path, scan, dz05_path
+
+    def render_arrays(self, radar, scan, logger):
+        """ Render the array and the dualpol array of a scan by calling radar2mat for each """
+
+        arrays = {}
+
+        try:
+            data, _, _, y, x = radar2mat(radar, **self.array_render_config)
+            logger.info('[Array Rendering Success] scan %s' % scan)
+            arrays["array"] = data
+        except Exception as ex:
+            logger.error('[Array Rendering Failure] scan %s - %s' % (scan, str(ex)))
+
+        try:
+            data, _, _, y, x = radar2mat(radar, **self.dualpol_render_config)
+            logger.info('[Dualpol Rendering Success] scan %s' % scan)
+            arrays["dualpol_array"] = data
+        except Exception as ex:
+            logger.error('[Dualpol Rendering Failure] scan %s - %s' % (scan, str(ex)))
+
+        return arrays
+
+    def render_arrays_combined(self, radar, scan, logger):
+        """
+            Render the array and the dualpol array of a scan through one NearestMapping,
+            i.e. the polar-to-Cartesian mapping is computed once per sweep
+            and shared by all six fields.
+            This reimplements the nearest-neighbor interpolation of radar2mat rather than calling it and is
+            experimental until development/benchmarks/check_render_parity.py has compared the two on real scans,
+            including split-cut VCPs and scans without dual-pol fields.
+        """
+
+        arrays = {}
+        try:
+            mapping = NearestMapping(radar, **get_geometry(self.array_render_config))
+        except Exception as ex:
+            mapping = None
+            logger.error('[Array Rendering Failure] scan %s - %s' % (scan, str(ex)))
+            logger.error('[Dualpol Rendering Failure] scan %s - %s' % (scan, str(ex)))
+
+        if mapping is not None:
+            for name, config, label in [
+                ("array", self.array_render_config, "Array"),
+                ("dualpol_array", self.dualpol_render_config, "Dualpol"),
+            ]:
+                try:
+                    arrays[name] = mapping.gather(radar, config["fields"])
+                    logger.info('[%s Rendering Success] scan %s' % (label, scan))
+                except Exception as ex:
+                    logger.error('[%s Rendering Failure] scan %s - %s' % (label, scan, str(ex)))
+        return arrays
+
     def render_img(self, array, utc_date_station_prefix, scan):
         attributes = self.array_render_config['fields']
         elevations = self.array_render_config['elevs']
@@ -162,3 +282,33 @@ class Renderer:
                 # flip the y axis, from geographical (big y means North) to image (big y means lower)
                 # omit the fourth alpha dimension, NAN are black but not white
             imsave(os.path.join(self.imgdirs[(attr, elev)], utc_date_station_prefix, f"{scan}.jpg"), rgb)
+
+
+class _LogCollector:
+    """ Collect log messages in a rendering worker process so that the parent can write them to the station-day log """
+
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, msg):
+        self.records.append((level, msg))
+
+    def info(self, msg):
+        self.log(logging.INFO, msg)
+
+    def error(self, msg):
+        self.log(logging.ERROR, msg)
+
+
+# the renderer of a rendering process, set once by the pool initializer
+_WORKER_RENDERER = None
+
+
+def _init_render_worker(renderer):
+    global _WORKER_RENDERER
+    _WORKER_RENDERER = renderer
+
+
+def _render_scan_in_worker(key, force_rendering):
+    collector = _LogCollector()
+    return _WORKER_RENDERER.render_scan(key, collector, force_rendering=force_rendering), collector.records
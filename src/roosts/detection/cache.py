@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+DETECTION_CACHE_VERSION = 1  # bump when the cached content or the detector outputs change
+
+
+class DetectionCache:
+
+    """
+        On-disk cache of the raw detections of each scan, so that re-running a dataset after a change in tracking,
+        postprocessing or counting skips the detection model. Detections are saved as
+        {cache_dir}/{config hash}/{station}/{yyyy}/{mm}/{dd}/{scanname}.json, where the config hash covers
+        everything the detections depend on besides the input, i.e. the model checkpoint and the detector config.
+        The input of a scan is identified by the names of the scans it is made of, which for v3 models include
+        the two previous scans, so that a different list of scans for the day does not reuse stale detections.
+    """
+
+    def __init__(self, cache_dir, config):
+        self.config_hash = hashlib.sha1(
+            json.dumps({"cache_version": DETECTION_CACHE_VERSION, **config}, sort_keys=True).encode()
+        ).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, self.config_hash)
+
+    @staticmethod
+    def checkpoint_signature(ckpt_path):
+        """ Path, size and modification time of a checkpoint, so that a retrained checkpoint misses the cache """
+        if ckpt_path is None or not os.path.exists(ckpt_path):
+            return ckpt_path
+        stat = os.stat(ckpt_path)
+        return f"{os.path.abspath(ckpt_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    def _path(self, scanname):
+        station, date = scanname[:4], scanname[4:12]
+        return os.path.join(self.cache_dir, station, date[:4], date[4:6], date[6:8], f"{scanname}.json")
+
+    def get(self, scanname, window):
+        """ Cached [(det_score, im_bbox)] of a scan, None if not cached for this input window """
+        path = self._path(scanname)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached["window"] != list(window):
+            return None
+        return [
+            (np.float32(det["det_score"]), np.array(det["im_bbox"], dtype=np.float32))
+            for det in cached["detections"]
+        ]
+
+    def put(self, scanname, window, detections):
+        """ Cache the detections of a scan, as output by Detector.run """
+        path = self._path(scanname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cached = {
+            "window": list(window),
+            "detections": [
+                {"det_score": float(det["det_score"]), "im_bbox": [float(v) for v in det["im_bbox"]]}
+                for det in detections
+            ],
+        }
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # written then renamed, other processes may read concurrently
+        with open(tmp_path, "w") as f:
+            json.dump(cached, f)
+        os.replace(tmp_path, path)
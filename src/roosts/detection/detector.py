@@ -1,12 +1,44 @@
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import detectron2
+import torch
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultPredictor
 from detectron2 import model_zoo
-import matplotlib.colors as pltc
 import numpy as np
 import os
 from tqdm import tqdm
 from geotiff import GeoTiff
+from roosts.detection.cache import DetectionCache
+from roosts.detection.export import ExportedPredictor, prepare_image
+from roosts.detection.prescreen import Prescreen
+from roosts.detection.server import InferenceClient
+from roosts.detection.quantization import PRECISIONS, load_int8, precision_context, to_float32
+from roosts.utils.array_util import RenderedScan
+from roosts.utils.cpu_util import configure_cpu_threads
+
+# channels of the detector input, 3 per scan
+CHANNELS = [("reflectivity", 0.5), ("reflectivity", 1.5), ("velocity", 0.5)]
+# (vmin, vmax) of each field, mapped to [0, 1] before the conversion to uint8
+NORMALIZE_RANGES = {
+        'reflectivity':              (  -5,   35),
+        'velocity':                  ( -15,   15),
+        'spectrum_width':            (   0,   10),
+        'differential_reflectivity': (  -4,    8),
+        'differential_phase':        (   0,  250),
+        'cross_correlation_ratio':   (   0,  1.1),
+}
+
+
+def _normalize_scalar(value):
+    """ A normalization bound in the type used by matplotlib.colors.Normalize, small integers become float32 """
+    dtype = np.min_scalar_type(value)
+    if np.issubdtype(dtype, np.integer):
+        dtype = np.promote_types(dtype, np.float32)
+    return dtype.type(value)
+
 
 class Detector:
 
@@ -20,7 +52,22 @@ class Detector:
             config_file,       # define the detection model
             use_gpu,           # GPU or CPU
             version,           # detector version
+            frame_cache_size=3,  # number of normalized scans kept for reuse, v3 inputs stack 3 consecutive scans
+            batch_size=1,      # number of scans per forward pass, 1 runs the predictor on one scan at a time
+            prefetch_depth=0,  # number of scans prepared ahead of inference in background threads, 0 to disable
+            prefetch_workers=1,  # number of threads preparing scans when prefetching
+            exported_model_path=None,  # run a model exported by roosts.detection.export on CPU instead of eager
+            precision="fp32",  # fp32, bf16 or int8, see roosts.detection.quantization
+            quantized_model_path=None,  # int8 weights and scales from tools/calibrate_detector.py, required for int8
+            num_threads=None,  # torch intra-op threads, None keeps the torch default
+            num_interop_threads=None,  # torch inter-op threads, None keeps the torch default
+            cpu_affinity=None,  # list of cpu ids to pin the process to, None to not pin
+            prescreen_cfg=None,  # arguments of Prescreen to skip scans without plausible roosts, None to run on all
+            cache_dir=None,    # directory of the on-disk detection cache, None to always run the model
+            server_socket=None,  # run the model in the inference server listening on this unix socket
+                                 # (tools/inference_server.py) instead of loading it in this process
     ):
+        self.cpu_config = configure_cpu_threads(num_threads, num_interop_threads, cpu_affinity)
 
         cfg = get_cfg()
         cfg.merge_from_file(model_zoo.get_config_file(config_file))
@@ -36,8 +83,19 @@ class Detector:
         cfg.MODEL.DEVICE = 'cuda' if use_gpu else 'cpu'
 
         self.version = version
+        self.frame_cache_size = frame_cache_size
+        self.batch_size = max(1, batch_size)
+        self.prefetch_depth = max(0, prefetch_depth)
+        self.prefetch_workers = max(1, prefetch_workers)
+        self.input_wait_time = 0.  # seconds the last run spent waiting for inputs to be prepared
+        self.prescreen = Prescreen(**prescreen_cfg) if prescreen_cfg is not None else None
+        self.skipped_scans = {}  # {scanname: prescreen statistics} of scans skipped in the last run
+        self.num_cached = 0  # number of scans whose detections were read from the cache in the last run
+        self._frame_cache_lock = threading.Lock()
+        self._frame_cache = collections.OrderedDict()  # {npz path: uint8 3-channel image}, oldest first
+        self._buffers = threading.local()  # per-thread float buffers for normalization, reused across scans
         if version == "v2":
-            self.predictor = DefaultPredictor(cfg)
+            predictor_class = DefaultPredictor
         elif version == "v3":
             import roosts.detection.adaptors_fpn as adaptors_fpn
             cfg.MODEL.BACKBONE.NAME = "build_adaptor_resnet_fpn_backbone"
@@ -48,83 +106,288 @@ class Detector:
             for _ in range(cfg.ADAPTOR_IN_CHANNELS):
                 cfg.MODEL.PIXEL_MEAN.append(127.5)
                 cfg.MODEL.PIXEL_STD.append(1.0)
-            self.predictor = adaptors_fpn.AdaptorPredictor(cfg)
+            predictor_class = adaptors_fpn.AdaptorPredictor
         else:
             raise NotImplementedError
 
-    def _preprocess_npz_file(self, npz_paths):
+        assert precision in PRECISIONS, f"Unknown precision {precision}"
+        self.precision = precision
+        # everything the detections depend on besides the input
+        self.model_config = {
+            "ckpt_path":        DetectionCache.checkpoint_signature(ckpt_path),
+            "imsize":           imsize,
+            "anchor_sizes":     anchor_sizes,
+            "nms_thresh":       nms_thresh,
+            "score_thresh":     score_thresh,
+            "config_file":      config_file,
+            "version":          version,
+            "exported_model_path": DetectionCache.checkpoint_signature(exported_model_path),
+            "precision":        precision,
+            "quantized_model_path": DetectionCache.checkpoint_signature(quantized_model_path),
+        }
+        self.cache = DetectionCache(cache_dir, self.model_config) if cache_dir is not None else None
+
+        if server_socket is not None:
+            self.predictor = None
+            self.server = InferenceClient(server_socket, self.model_config)
+            return
+        self.server = None
+
+        if exported_model_path is None:
+            self.predictor = predictor_class(cfg)
+        else:
+            self.predictor = ExportedPredictor(cfg, version, exported_model_path)
+
+        if precision != "fp32":
+            assert not use_gpu and exported_model_path is None, "reduced precision is for the eager model on CPU"
+        if precision == "int8":
+            assert quantized_model_path is not None, "int8 inference needs calibrated weights"
+            load_int8(self.predictor.model, quantized_model_path)
+
+    def close(self):
+        """ Close the connection to the inference server, if any """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    def _buffer(self, shape, dtype):
+        """ A float buffer of this thread, reused across scans """
+        buffers = self._buffers.__dict__
+        if (shape, dtype) not in buffers:
+            buffers[(shape, dtype)] = np.empty(shape, dtype=dtype)
+        return buffers[(shape, dtype)]
+
+    def _channel_to_uint8(self, channel, field, out):
+        """
+            Normalize a channel and convert it to uint8 into out, in float buffers reused across scans.
+            This fuses matplotlib.colors.Normalize, nan_to_num, * 255 and astype(np.uint8) on masked arrays
+            with the same arithmetic, order and precisions, so the uint8 values are identical:
+            Normalize computes in the dtype of the channel, while np.ma multiplies by 255 as a 0-d integer array.
+        """
+        dtype = channel.dtype if np.issubdtype(channel.dtype, np.floating) else np.dtype(np.float64)
+        normalized = self._buffer(channel.shape, dtype)
+        vmin, vmax = (_normalize_scalar(v) for v in NORMALIZE_RANGES[field])
+        np.subtract(channel, vmin, out=normalized)
+        np.divide(normalized, vmax - vmin, out=normalized)
+        np.nan_to_num(normalized, copy=False, nan=0.0)
+
+        scale = np.asarray(255)
+        scaled = self._buffer(channel.shape, np.result_type(normalized, scale))
+        np.multiply(normalized, scale, out=scaled)
+        np.copyto(out, scaled, casting="unsafe")
+
+    def _normalize_npz_file(self, npz_path, scan=None):
 
         # extract useful information from raw scan file, normalize the data and convert it to uint8
-        CHANNELS = [("reflectivity", 0.5), ("reflectivity", 1.5), ("velocity", 0.5)]
-        NORMALIZERS = {
-                'reflectivity':              pltc.Normalize(vmin=  -5, vmax= 35),
-                'velocity':                  pltc.Normalize(vmin= -15, vmax= 15),
-                'spectrum_width':            pltc.Normalize(vmin=   0, vmax= 10),
-                'differential_reflectivity': pltc.Normalize(vmin=  -4, vmax= 8),
-                'differential_phase':        pltc.Normalize(vmin=   0, vmax= 250),
-                'cross_correlation_ratio':   pltc.Normalize(vmin=   0, vmax= 1.1)
-        }
-        attributes = ['reflectivity', 'velocity', 'spectrum_width']
-        elevations = [0.5, 1.5, 2.5, 3.5, 4.5]
+        # scan is the RenderedScan of npz_path if it is already open
+        if scan is None:
+            with RenderedScan(npz_path) as scan:
+                return self._normalize_npz_file(npz_path, scan)
+        image = None
+        for c, (attr, elev) in enumerate(CHANNELS):
+            channel = scan.get(attr, elev) # only the channels used here are read
+            if image is None:
+                image = np.empty(channel.shape + (len(CHANNELS),), dtype=np.uint8)
+            self._channel_to_uint8(channel, attr, image[:, :, c])
+        return image
 
+    def _preprocess_npz_file(self, npz_paths, open_scans=None):
+
+        # stack the normalized scans along channels, each scan is read and normalized once while
+        # it stays in the sliding window of the last frame_cache_size scans
+        # with prefetching, windows are prepared concurrently and a scan may occasionally be normalized twice
+        # open_scans are {npz_path: RenderedScan} already opened, e.g. by the prescreen
         image_list = []
-        for i in range(len(npz_paths)):
-            array = np.load(npz_paths[i])["array"]
-            image_list.append(np.stack([
-                NORMALIZERS[attr](array[attributes.index(attr), elevations.index(elev), :, :])
-                for (attr, elev) in CHANNELS
-            ], axis=-1))
-        
+        for npz_path in npz_paths:
+            with self._frame_cache_lock:
+                image = self._frame_cache.get(npz_path)
+            if image is None:
+                image = self._normalize_npz_file(npz_path, (open_scans or {}).get(npz_path))
+                with self._frame_cache_lock:
+                    self._frame_cache[npz_path] = image
+                    while len(self._frame_cache) > self.frame_cache_size:
+                        self._frame_cache.popitem(last=False)
+            image_list.append(image)
+
+        # a new array per input, as inputs may be held by the prefetching and batching while later ones are prepared
         return np.concatenate(image_list, axis=2)
 
+    def _predict(self, images):
+        """
+            Run the model on a list of input images, return the (scores, boxes, image_size) of each image.
+            Images are resized the same way as DefaultPredictor and AdaptorPredictor do for a single image,
+            then passed to the model in a single forward pass.
+        """
+        if self.server is not None:
+            return self.server.predict(images)
+
+        predictor = self.predictor
+        with torch.no_grad(), precision_context(self.precision):
+            inputs = []
+            for original_image in images:
+                height, width = original_image.shape[:2]
+                image = prepare_image(predictor.aug, predictor.input_format, original_image)
+                inputs.append({"image": image, "height": height, "width": width})
+            predictions = predictor.model(inputs)
+        if self.precision != "fp32":
+            predictions = [to_float32(prediction) for prediction in predictions]
+        return [self._prediction_to_numpy(prediction) for prediction in predictions]
+
+    @staticmethod
+    def _prediction_to_numpy(prediction):
+        """ (scores, boxes, image_size) of a detectron2 prediction as numpy arrays, e.g. to be sent to a client """
+        instances = prediction["instances"]
+        return instances.scores.cpu().numpy(), instances.pred_boxes.tensor.cpu().numpy(), instances.image_size
+
+    def _reformat_predictions(self, name, prediction, file_type, det_ID_start):
+        """ Convert the (scores, boxes, image_size) of a scan to detections with det_ID starting from det_ID_start """
+        scores, bbox, (H, W) = prediction
+        if len(scores) == 0: # no roost detected in this scan
+            return []
+        centers    = (bbox[:, :2] + bbox[:, 2:]) / 2
+        if file_type == "npz":
+            # flip the y axis, from geographical (big y means North) to image (big y means lower)
+            centers[:, 1] = H - centers[:, 1]
+        radius     = ((bbox[:, 2] - bbox[:, 0]) + (bbox[:, 3] - bbox[:, 1])) / 4.
+        radius     = radius[:, np.newaxis]
+        bbox_xyr   = np.hstack((centers, radius))
+        # reformat the detections
+        dets = []
+        for kk in range(len(scores)):
+            det = {
+                "scanname" : name, 
+                "det_ID"   : det_ID_start + kk,
+                "det_score": scores[kk],
+                "im_bbox"  : bbox_xyr[kk],
+            }
+            dets.append(det)
+        return dets
+
+    def _input_files(self, array_files, idx, file_type):
+        """ The files the input of the idx-th scan is made of """
+        file = array_files[idx]
+        if file_type == "tiff" or self.version == "v2":
+            return [file]
+        elif self.version == "v3":
+            if idx == 0:
+                return [file, file, file]
+            elif idx == 1:
+                return [array_files[0], array_files[0], file]
+            else:
+                return [array_files[idx - 2], array_files[idx - 1], file]
+        else:
+            raise NotImplementedError
+
+    def _load_input(self, array_files, idx, file_type):
+        """
+            Prepare the idx-th scan for detection, return (window, input image, cached detections) where
+            window identifies the input in the detection cache. The input image is the uint8 input of the model,
+            None if the detections are cached; both are None if the scan is skipped by the prescreen.
+        """
+        file = array_files[idx]
+        name = os.path.splitext(os.path.basename(file))[0]
+        # opened once, so that the arrays read by the prescreen are reused to prepare the input
+        scan = RenderedScan(file) if file_type == "npz" else None
+        try:
+            if scan is not None and self.prescreen is not None:
+                keep, stats = self.prescreen(scan)
+                if not keep:
+                    self.skipped_scans[name] = stats
+                    return None, None, None
+
+            file_list = self._input_files(array_files, idx, file_type)
+            window = [file_type] + [os.path.splitext(os.path.basename(f))[0] for f in file_list]
+            if self.cache is not None:
+                cached = self.cache.get(name, window)
+                if cached is not None:
+                    return window, None, cached
+
+            if file_type == "npz":
+                return window, self._preprocess_npz_file(file_list, {file: scan}), None
+            elif file_type == "tiff":
+                data = np.array(GeoTiff(file, crs_code=4326).read())
+                np.nan_to_num(data, copy=False, nan=0.0)
+                return window, (data * 255).astype(np.uint8), None
+        finally:
+            if scan is not None:
+                scan.close()
+
+    def _iter_inputs(self, array_files, file_type):
+        """
+            Yield the prepared input of each scan in order, see _load_input. With prefetch_depth > 0, up to prefetch_depth scans
+            are prepared ahead by prefetch_workers threads while the model runs on earlier scans;
+            loading, decompression and normalization are mostly numpy and zlib work, which releases the GIL.
+        """
+        if self.prefetch_depth == 0:
+            for idx in range(len(array_files)):
+                yield self._load_input(array_files, idx, file_type)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.prefetch_workers) as executor:
+            futures = collections.deque()
+            for idx in range(len(array_files)):
+                futures.append(executor.submit(self._load_input, array_files, idx, file_type))
+                if len(futures) > self.prefetch_depth:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def _detect(self, batch, file_type, det_ID_start):
+        """
+            Detect roosts in a batch of (scanname, window, input image, cached detections) in order,
+            run the model on the scans without cached detections and cache their detections.
+            Return detections with det_ID from det_ID_start.
+        """
+        images = [data for (_, _, data, _) in batch if data is not None]
+        predictions = iter(self._predict(images)) if len(images) > 0 else iter([])
+        outputs = []
+        for name, window, data, cached in batch:
+            if cached is None:
+                dets = self._reformat_predictions(name, next(predictions), file_type, det_ID_start + len(outputs))
+                if self.cache is not None:
+                    self.cache.put(name, window, dets)
+            else:
+                dets = [
+                    {
+                        "scanname" : name,
+                        "det_ID"   : det_ID_start + len(outputs) + kk,
+                        "det_score": det_score,
+                        "im_bbox"  : im_bbox,
+                    }
+                    for kk, (det_score, im_bbox) in enumerate(cached)
+                ]
+            outputs.extend(dets)
+        return outputs
+
     def run(self, array_files, file_type = "npz"):
+        self._frame_cache.clear() # arrays may have been re-rendered since the last run
+        self.input_wait_time = 0.
+        self.skipped_scans = {}
+        self.num_cached = 0
         outputs = []
-        count = 0
-        for idx, file in enumerate(tqdm(array_files, desc="Detecting")):
+        batch = [] # (scanname, window, input image, cached detections) of scans waiting for detection
+        num_images = 0 # number of scans in batch to run the model on
+        inputs = self._iter_inputs(array_files, file_type)
+        for file in tqdm(array_files, desc="Detecting"):
             # extract scanname 
             name = os.path.splitext(os.path.basename(file))[0]
-            # preprocess data
-            if file_type == "npz":
-                if self.version == "v2":
-                    file_list = [file]
-                elif self.version == "v3":
-                    if idx == 0:
-                        file_list = [file, file, file]
-                    elif idx == 1:
-                        file_list = [array_files[0], array_files[0], file]
-                    else:
-                        file_list = [array_files[idx - 2], array_files[idx - 1], file]
-                else:
-                    raise NotImplementedError
-                data = self._preprocess_npz_file(file_list)
-            elif file_type == "tiff":
-                data = np.array(GeoTiff(file, crs_code=4326).read())
-            np.nan_to_num(data, copy=False, nan=0.0)
-            data = (data * 255).astype(np.uint8)
-            # detect roosts 
-            prediction = self.predictor(data)["instances"]
-            scores     = prediction.scores.cpu().numpy()
-            if len(scores) == 0: # no roost detected in this scan
+            # preprocess data, or wait for the prefetched input
+            start_time = time.time()
+            window, data, cached = next(inputs)
+            self.input_wait_time += time.time() - start_time
+            if data is None and cached is None: # skipped by the prescreen
                 continue
-            bbox       = prediction.pred_boxes.tensor.cpu().numpy()
-            H, W       = prediction.image_size
-            centers    = prediction.pred_boxes.get_centers().cpu().numpy()
-            if file_type == "npz":
-                # flip the y axis, from geographical (big y means North) to image (big y means lower)
-                centers[:, 1] = H - centers[:, 1]
-            radius     = ((bbox[:, 2] - bbox[:, 0]) + (bbox[:, 3] - bbox[:, 1])) / 4.
-            radius     = radius[:, np.newaxis]
-            bbox_xyr   = np.hstack((centers, radius))
-            # reformat the detections
-            for kk in range(len(scores)):
-                det = {
-                    "scanname" : name, 
-                    "det_ID"   : count,
-                    "det_score": scores[kk],
-                    "im_bbox"  : bbox_xyr[kk],
-                }
-                count += 1
-                outputs.append(det)
+            batch.append((name, window, data, cached))
+            if cached is not None:
+                self.num_cached += 1
+            else:
+                num_images += 1
+            # detect roosts once batch_size scans are preprocessed
+            if num_images == self.batch_size:
+                outputs.extend(self._detect(batch, file_type, len(outputs)))
+                batch, num_images = [], 0
+        if len(batch) > 0:
+            outputs.extend(self._detect(batch, file_type, len(outputs)))
 
         return outputs
 
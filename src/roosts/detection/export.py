@@ -0,0 +1,126 @@
+"""
+Export of the roost detector to TorchScript or ONNX, and a predictor that runs the exported graph on CPU.
+
+The exported graph covers the detectron2 model from the resized input image to the boxes, scores and classes
+before they are rescaled to the input size, i.e. the backbone (including the Adaptor_FPN of v3 models),
+the RPN and the ROI heads. Resizing the input and rescaling the outputs stay in python, as in DefaultPredictor
+and AdaptorPredictor. Tracing records the control flow for the sample input size, which is fine since
+inputs are always resized to imsize x imsize.
+"""
+
+import numpy as np
+import torch
+from torch import nn
+from detectron2.data import transforms as T
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+EXPORT_FORMATS = {
+    "torchscript":  ".ts",
+    "onnx":         ".onnx",
+}
+ONNX_OPSET_VERSION = 16
+
+
+class InferenceGraph(nn.Module):
+    """ The model from a resized (C, H, W) float image to (boxes, scores, classes) before rescaling """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        instances = self.model.inference([{"image": image}], do_postprocess=False)[0]
+        return instances.pred_boxes.tensor, instances.scores, instances.pred_classes
+
+
+def get_resize_augmentation(cfg, version):
+    """ The resizing applied to input images by the predictor of each detector version """
+    if version == "v3":
+        from roosts.detection.adaptors_fpn import CustomResize
+        return CustomResize((cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST))
+    return T.ResizeShortestEdge([cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MIN_SIZE_TEST], cfg.INPUT.MAX_SIZE_TEST)
+
+
+def prepare_image(aug, input_format, original_image):
+    """ Resize a (H, W, C) uint8 input image into the contiguous (C, H, W) float32 tensor taken by the model """
+    if input_format == "RGB":
+        original_image = original_image[:, :, ::-1]
+    image = aug.get_transform(original_image).apply_image(original_image)
+    return torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1), dtype=np.float32))
+
+
+def export_detector(detector, sample_image, output_path, export_format="torchscript"):
+    """
+        Export the eager model of a Detector, traced on sample_image, a (H, W, C) uint8 input image such as
+        the ones prepared by Detector.run. A real scan should be used so that every stage of the model is traced.
+    """
+    assert export_format in EXPORT_FORMATS, f"Unknown export format {export_format}"
+    predictor = detector.predictor
+    model = predictor.model.eval()
+    image = prepare_image(predictor.aug, predictor.input_format, sample_image)
+    graph = InferenceGraph(model).eval()
+
+    with torch.no_grad():
+        if export_format == "torchscript":
+            traced = torch.jit.trace(graph, (image,)) # reruns the traced graph and checks its outputs
+            traced.save(output_path)
+        elif export_format == "onnx":
+            torch.onnx.export(
+                graph, (image,), output_path,
+                opset_version=ONNX_OPSET_VERSION,
+                input_names=["image"],
+                output_names=["boxes", "scores", "classes"],
+            )
+    return output_path
+
+
+class ExportedPredictor:
+    """
+        Run a detector exported by export_detector on CPU, with the interface of DefaultPredictor:
+        predictor(original_image) returns {"instances": Instances} in the coordinates of the input image.
+        TorchScript graphs are frozen and optimized for inference by torch.jit;
+        ONNX graphs are run by onnxruntime with all graph optimizations enabled.
+    """
+
+    def __init__(self, cfg, version, model_path):
+        self.input_format = cfg.INPUT.FORMAT
+        self.aug = get_resize_augmentation(cfg, version)
+
+        if model_path.endswith(EXPORT_FORMATS["onnx"]):
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise ImportError("onnxruntime is required to run a detector exported to ONNX")
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+            self.module = None
+        else:
+            self.session = None
+            module = torch.jit.load(model_path, map_location="cpu").eval()
+            self.module = torch.jit.optimize_for_inference(torch.jit.freeze(module))
+
+    def _run_graph(self, image):
+        if self.session is not None:
+            boxes, scores, classes = self.session.run(None, {"image": image.numpy()})
+            return torch.as_tensor(boxes), torch.as_tensor(scores), torch.as_tensor(classes)
+        with torch.no_grad():
+            return self.module(image)
+
+    def _predict(self, image, height, width):
+        boxes, scores, classes = self._run_graph(image)
+        instances = Instances(tuple(image.shape[1:]))
+        instances.pred_boxes = Boxes(boxes)
+        instances.scores = scores
+        instances.pred_classes = classes
+        return {"instances": detector_postprocess(instances, height, width)}
+
+    def model(self, inputs):
+        """ Batch interface of detectron2 models, the exported graph runs on one image at a time """
+        return [self._predict(x["image"], x["height"], x["width"]) for x in inputs]
+
+    def __call__(self, original_image):
+        height, width = original_image.shape[:2]
+        image = prepare_image(self.aug, self.input_format, original_image)
+        return self._predict(image, height, width)
@@ -0,0 +1,65 @@
+import functools
+import numpy as np
+from roosts.utils.array_util import RenderedScan
+
+
+@functools.lru_cache(maxsize=4)
+def _annulus_mask(dim, geosize, r_min, r_max):
+    """ Pixels of a dim x dim rendering covering geosize meters whose distance to the radar is in [r_min, r_max] """
+    x = y = np.linspace(-geosize / 2, geosize / 2, dim)
+    X, Y = np.meshgrid(x, y)
+    R = np.sqrt(X ** 2 + Y ** 2)
+    return (R >= r_min) & (R <= r_max)
+
+
+class Prescreen:
+
+    """
+        A cheap test of whether a rendered scan may contain roosts, run before the detector.
+        It uses the reflectivity of the lowest sweep within an annulus around the radar:
+        a scan is skipped as clear air if too few pixels have echoes above echo_dbz,
+        or, if max_rain_fraction is set, as precipitation-covered if too many pixels are above rain_dbz.
+    """
+
+    def __init__(
+            self,
+            echo_dbz=5.,                # reflectivity above which a pixel has echoes that may come from animals
+            min_echo_fraction=0.001,    # skip scans with a lower fraction of annulus pixels above echo_dbz
+            rain_dbz=35.,               # reflectivity above which a pixel is considered as precipitation
+            max_rain_fraction=None,     # skip scans with a higher fraction of annulus pixels above rain_dbz,
+                                        # None to never skip scans for precipitation
+            r_min=5000.,                # inner radius of the annulus in meters, excludes ground clutter
+            r_max=150000.,              # outer radius of the annulus in meters
+            geosize=300000,             # the rendered arrays cover geosize x geosize meters centered at the radar
+            elevation=0.5,
+    ):
+        self.echo_dbz = echo_dbz
+        self.min_echo_fraction = min_echo_fraction
+        self.rain_dbz = rain_dbz
+        self.max_rain_fraction = max_rain_fraction
+        self.r_min = r_min
+        self.r_max = r_max
+        self.geosize = geosize
+        self.elevation = elevation
+
+    def __call__(self, scan):
+        """
+            Return whether to run the detector on the scan, and the statistics the decision is based on.
+            scan is the path of the rendered arrays, or an open RenderedScan whose loaded arrays are then reused.
+        """
+        if isinstance(scan, RenderedScan):
+            reflectivity = scan.get("reflectivity", self.elevation)
+        else:
+            with RenderedScan(scan) as rendered:
+                reflectivity = rendered.get("reflectivity", self.elevation)
+
+        values = reflectivity[_annulus_mask(reflectivity.shape[0], self.geosize, self.r_min, self.r_max)]
+        with np.errstate(invalid="ignore"):  # NaN means no data and compares as False
+            stats = {
+                "echo_fraction": float(np.count_nonzero(values > self.echo_dbz)) / values.size,
+                "rain_fraction": float(np.count_nonzero(values > self.rain_dbz)) / values.size,
+            }
+        keep = stats["echo_fraction"] >= self.min_echo_fraction and (
+            self.max_rain_fraction is None or stats["rain_fraction"] <= self.max_rain_fraction
+        )
+        return keep, stats
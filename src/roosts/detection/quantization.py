@@ -0,0 +1,243 @@
+"""
+Reduced-precision inference of the roost detector on CPU.
+
+    bf16: the model runs under torch.autocast, convolutions and linear layers compute in bfloat16
+    int8: the ResNet, the FPN and the box head of the ROI heads run with int8 weights and activations.
+          FrozenBatchNorm is folded into the convolution weights and each ReLU is fused into the convolution
+          or linear layer before it. Activation scales are calibrated on rendered scans by calibrate_int8 and
+          saved with the weights, from which load_int8 restores the quantized model.
+
+int8 modules are quantized in eager mode, so detectron2 modules need not be traceable: the ResNet stem, its
+bottleneck blocks, the FPN top-down path and the box head are replaced by equivalent modules whose forward is
+quantizable. Activations are quantized once at the input of the ResNet and stay int8 through its stages and
+the FPN, which dequantizes its outputs for the RPN and the ROI pooler; the box head quantizes its pooled input
+and dequantizes its output. The v3 adaptor, the RPN and the box predictor stay in float.
+Detections of a reduced precision drift slightly from fp32;
+development/benchmarks/benchmark_detector_precision.py measures the drift and the speed.
+"""
+
+import contextlib
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.ao.nn.intrinsic import ConvReLU2d, LinearReLU
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, get_default_qconfig, prepare
+from detectron2.layers import FrozenBatchNorm2d
+from detectron2.modeling.backbone.resnet import BottleneckBlock
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+QUANTIZATION_ENGINE = "fbgemm"
+
+
+def _fold_norm(conv):
+    """ Weight and bias of a Conv2d with its FrozenBatchNorm, if any, folded in """
+    weight = conv.weight.detach().clone()
+    bias = conv.bias.detach().clone() if conv.bias is not None else torch.zeros(conv.out_channels)
+    norm = getattr(conv, "norm", None)
+    if norm is not None:
+        if not isinstance(norm, FrozenBatchNorm2d):
+            raise ValueError(f"Cannot fold {type(norm).__name__} into an int8 convolution")
+        scale = norm.weight * (norm.running_var + norm.eps).rsqrt()
+        weight = weight * scale.reshape(-1, 1, 1, 1)
+        bias = (bias - norm.running_mean) * scale + norm.bias
+    return weight, bias
+
+
+def _plain_conv(conv):
+    """ A torch Conv2d computing a detectron2 Conv2d and its norm, without its activation """
+    plain = nn.Conv2d(
+        conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+        padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True,
+    )
+    weight, bias = _fold_norm(conv)
+    with torch.no_grad():
+        plain.weight.copy_(weight)
+        plain.bias.copy_(bias)
+    return plain
+
+
+def _plain_linear(linear):
+    plain = nn.Linear(linear.in_features, linear.out_features, bias=True)
+    with torch.no_grad():
+        plain.weight.copy_(linear.weight)
+        plain.bias.copy_(linear.bias if linear.bias is not None else torch.zeros(linear.out_features))
+    return plain
+
+
+class Int8Stem(nn.Module):
+    """ detectron2's BasicStem, quantizing the input of the ResNet: conv + ReLU fused, then max pooling """
+
+    def __init__(self, stem):
+        super().__init__()
+        self.quant = QuantStub()
+        self.conv1 = ConvReLU2d(_plain_conv(stem.conv1), nn.ReLU())
+
+    def forward(self, x):
+        return F.max_pool2d(self.conv1(self.quant(x)), kernel_size=3, stride=2, padding=1)
+
+
+class Int8Bottleneck(nn.Module):
+    """ detectron2's BottleneckBlock on int8 activations, with the ReLUs fused into the convs and the residual add """
+
+    def __init__(self, block):
+        super().__init__()
+        if not isinstance(block, BottleneckBlock):
+            raise ValueError(f"Cannot quantize a ResNet with {type(block).__name__} blocks")
+        self.conv1 = ConvReLU2d(_plain_conv(block.conv1), nn.ReLU())
+        self.conv2 = ConvReLU2d(_plain_conv(block.conv2), nn.ReLU())
+        self.conv3 = _plain_conv(block.conv3)
+        self.shortcut = _plain_conv(block.shortcut) if block.shortcut is not None else None
+        self.residual = FloatFunctional()
+
+    def forward(self, x):
+        out = self.conv3(self.conv2(self.conv1(x)))
+        shortcut = self.shortcut(x) if self.shortcut is not None else x
+        return self.residual.add_relu(out, shortcut)
+
+
+class Int8FPN(nn.Module):
+    """
+        Replaces the FPN backbone of a model (detectron2's FPN or Adaptor_FPN): runs its top-down path on the
+        int8 features of the quantized ResNet and dequantizes the output feature maps.
+    """
+
+    def __init__(self, fpn):
+        super().__init__()
+        self.fpn = fpn
+        names = {}
+        for name, conv in list(fpn.named_children()):
+            if name.startswith(("fpn_lateral", "fpn_output")):
+                names[id(conv)] = name
+                setattr(fpn, name, _plain_conv(conv))
+        # the FPN's lists of convs are not seen by prepare and convert, which swap registered modules,
+        # so the convs are looked up by name at each forward, in top-down order
+        self.lateral_names = [names[id(conv)] for conv in fpn.lateral_convs]
+        self.output_names = [names[id(conv)] for conv in fpn.output_convs]
+        fpn.lateral_convs = fpn.output_convs = None
+        self.top_down_adds = nn.ModuleList(FloatFunctional() for _ in self.lateral_names[1:])
+        self.dequant = DeQuantStub()
+
+    @property
+    def size_divisibility(self):
+        return self.fpn.size_divisibility
+
+    @property
+    def padding_constraints(self):
+        return self.fpn.padding_constraints
+
+    def output_shape(self):
+        return self.fpn.output_shape()
+
+    def forward(self, x):
+        fpn = self.fpn
+        if getattr(fpn, "is_adaptor", False):
+            x = fpn.adaptor(x)
+
+        # same as FPN.forward, on quantized features
+        lateral_convs = [getattr(fpn, name) for name in self.lateral_names]
+        output_convs = [getattr(fpn, name) for name in self.output_names]
+        bottom_up_features = fpn.bottom_up(x)
+        x = [bottom_up_features[f] for f in fpn.in_features[::-1]]
+        prev_features = lateral_convs[0](x[0])
+        results = [self.dequant(output_convs[0](prev_features))]
+        for features, lateral_conv, output_conv, add in zip(
+                x[1:], lateral_convs[1:], output_convs[1:], self.top_down_adds
+        ):
+            top_down_features = F.interpolate(prev_features, scale_factor=2.0, mode="nearest")
+            prev_features = add.add(lateral_conv(features), top_down_features)
+            if fpn._fuse_type == "avg":
+                prev_features = add.mul_scalar(prev_features, 0.5)
+            results.insert(0, self.dequant(output_conv(prev_features)))
+
+        if fpn.top_block is not None:
+            if fpn.top_block.in_feature in bottom_up_features:
+                top_block_in_feature = self.dequant(bottom_up_features[fpn.top_block.in_feature])
+            else:
+                top_block_in_feature = results[fpn._out_features.index(fpn.top_block.in_feature)]
+            results.extend(fpn.top_block(top_block_in_feature))
+        assert len(fpn._out_features) == len(results)
+        return dict(zip(fpn._out_features, results))
+
+
+class Int8BoxHead(nn.Module):
+    """ detectron2's FastRCNNConvFCHead in int8 from its pooled input to its output, each ReLU fused """
+
+    def __init__(self, head):
+        super().__init__()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+        layers = []
+        for layer in head.children():
+            if isinstance(layer, nn.Conv2d):  # detectron2's Conv2d with a ReLU activation
+                layers.append(ConvReLU2d(_plain_conv(layer), nn.ReLU()))
+            elif isinstance(layer, nn.Linear):
+                layers.append(LinearReLU(_plain_linear(layer), nn.ReLU()))
+            elif isinstance(layer, nn.Flatten):
+                layers.append(layer)
+            elif not isinstance(layer, nn.ReLU):  # the ReLU after each fc is fused into it
+                raise ValueError(f"Cannot quantize {type(layer).__name__} in the box head")
+        self.layers = nn.Sequential(*layers)
+        self.output_shape = head.output_shape
+
+    def forward(self, x):
+        return self.dequant(self.layers(self.quant(x)))
+
+
+def prepare_int8(model):
+    """ Replace the quantized modules of a detectron2 model in place and insert the observers of activation scales """
+    torch.backends.quantized.engine = QUANTIZATION_ENGINE
+    qconfig = get_default_qconfig(QUANTIZATION_ENGINE)
+
+    resnet = model.backbone.bottom_up
+    resnet.stem = Int8Stem(resnet.stem)
+    for name in resnet.stage_names:
+        setattr(resnet, name, nn.Sequential(*[Int8Bottleneck(block) for block in getattr(resnet, name)]))
+    # ResNet.forward iterates this list; convert swaps the layers inside each stage, not the stages themselves
+    resnet.stages = [getattr(resnet, name) for name in resnet.stage_names]
+    model.backbone = Int8FPN(model.backbone)
+    model.roi_heads.box_head = Int8BoxHead(model.roi_heads.box_head)
+
+    model.backbone.qconfig = qconfig
+    model.roi_heads.box_head.qconfig = qconfig
+    if hasattr(model.backbone.fpn, "adaptor"):
+        model.backbone.fpn.adaptor.qconfig = None  # the adaptor of v3 models runs before the input is quantized
+    prepare(model, inplace=True)
+    return model
+
+
+def calibrate_int8(detector, array_files_by_day, output_path):
+    """
+        Quantize the model of a Detector to int8 in place, with activation scales calibrated by running
+        the detector on the rendered scans of a few station-days, and save the quantized weights to output_path.
+    """
+    model = detector.predictor.model
+    prepare_int8(model)
+    for array_files in array_files_by_day:
+        detector.run(array_files)
+    convert(model, inplace=True)
+    torch.save(model.state_dict(), output_path)
+    return model
+
+
+def load_int8(model, quantized_model_path):
+    """ Quantize a float model to int8 in place with the weights and scales saved by calibrate_int8 """
+    prepare_int8(model)
+    convert(model, inplace=True)
+    model.load_state_dict(torch.load(quantized_model_path, map_location="cpu"))
+    return model
+
+
+def precision_context(precision):
+    """ Context in which to run the model at a precision, int8 models need none """
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def to_float32(prediction):
+    """ Cast the outputs of a reduced-precision model back to float32 in place """
+    instances = prediction["instances"]
+    instances.scores = instances.scores.float()
+    instances.pred_boxes.tensor = instances.pred_boxes.tensor.float()
+    return prediction
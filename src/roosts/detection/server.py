@@ -0,0 +1,189 @@
+"""
+A long-lived inference server that holds detection models once per node for many RoostSystem jobs.
+
+Clients (Detector with server_socket) prepare their inputs as usual, including the prescreen and the detection
+cache, and send uint8 input images over a unix socket. Each client is served by the model with the same
+model_config, e.g. the v2 or v3 model, and by its own thread. The server queues the images of all clients
+of a model and its workers run the model on batches of up to max_batch_size images, possibly from different
+stations, waiting at most max_wait seconds for a batch to fill up.
+
+Messages are pickled by multiprocessing.connection, so only processes of the user running the server may
+connect: the socket is created with mode 0600, and each server generates a random authkey that it writes
+to {socket_path}.key, also with mode 0600, from which clients read it.
+"""
+
+import os
+import queue
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+AUTHKEY_SIZE = 32 # bytes
+
+
+def get_authkey_path(socket_path):
+    return f"{socket_path}.key"
+
+
+def read_authkey(socket_path):
+    """ The authkey of the server listening on socket_path """
+    path = get_authkey_path(socket_path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No authkey at {path}, is an inference server listening on {socket_path}?")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class _PendingImage:
+    """ An image waiting in the server queue, and its prediction once the model has run """
+
+    def __init__(self, image):
+        self.image = image
+        self.prediction = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceServer:
+
+    def __init__(
+            self,
+            detectors,          # Detectors that load the models, clients are matched to them by model_config
+            socket_path,        # unix socket to listen on
+            max_batch_size=4,   # maximum number of images per forward pass, from any clients of a model
+            max_wait=0.05,      # seconds to wait for more images before running a batch that is not full
+            num_workers=1,      # number of batches of each model run concurrently,
+                                # each using torch's intra-op threads
+    ):
+        self.detectors = detectors
+        self.socket_path = socket_path
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.num_workers = max(1, num_workers)
+        self.authkey = os.urandom(AUTHKEY_SIZE)
+        self.queues = [queue.Queue() for _ in detectors]
+        self._lock = threading.Lock() # guards the counters, updated by the workers of all models
+        self.num_batches = 0
+        self.num_images = 0
+
+    def _listen(self):
+        """ Write the authkey file, then create the socket, both readable and writable by the user only """
+        authkey_path = get_authkey_path(self.socket_path)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path) # left over by a server that did not exit cleanly
+        umask = os.umask(0o177)
+        try:
+            tmp_path = f"{authkey_path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.authkey)
+            os.replace(tmp_path, authkey_path)
+            return Listener(self.socket_path, family="AF_UNIX", authkey=self.authkey)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self):
+        listener = self._listen()
+        for model_idx in range(len(self.detectors)):
+            for _ in range(self.num_workers):
+                threading.Thread(target=self._run_batches, args=(model_idx,), daemon=True).start()
+        print(f"Inference server listening on {self.socket_path}", flush=True)
+
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    continue
+                threading.Thread(target=self._serve_client, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            os.remove(get_authkey_path(self.socket_path))
+
+    def _serve_client(self, conn):
+        model_idx = None
+        try:
+            while True:
+                request = conn.recv()
+                if request["type"] == "hello":
+                    configs = [detector.model_config for detector in self.detectors]
+                    if request["model_config"] in configs:
+                        model_idx = configs.index(request["model_config"])
+                        conn.send({"model_idx": model_idx})
+                    else:
+                        conn.send({"error": "no model with this config", "model_configs": configs})
+                elif request["type"] == "predict" and model_idx is not None:
+                    pending = [_PendingImage(image) for image in request["images"]]
+                    for item in pending:
+                        self.queues[model_idx].put(item)
+                    for item in pending:
+                        item.done.wait()
+                    errors = [item.error for item in pending if item.error is not None]
+                    if len(errors) > 0:
+                        conn.send({"error": errors[0]})
+                    else:
+                        conn.send({"predictions": [item.prediction for item in pending]})
+                else:
+                    conn.send({"error": f"unexpected {request['type']} request"})
+        except (EOFError, OSError):
+            pass # client disconnected
+        finally:
+            conn.close()
+
+    def _next_batch(self, model_idx):
+        model_queue = self.queues[model_idx]
+        batch = [model_queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(model_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self, model_idx):
+        detector = self.detectors[model_idx]
+        while True:
+            batch = self._next_batch(model_idx)
+            try:
+                predictions = detector._predict([item.image for item in batch])
+                for item, prediction in zip(batch, predictions):
+                    item.prediction = prediction
+            except Exception as ex:
+                for item in batch:
+                    item.error = f"{type(ex).__name__}: {ex}"
+            with self._lock:
+                self.num_batches += 1
+                self.num_images += len(batch)
+            for item in batch:
+                item.done.set()
+
+
+class InferenceClient:
+
+    """ Connection of a Detector to an InferenceServer, which must serve a model with the same config """
+
+    def __init__(self, socket_path, model_config):
+        self.conn = Client(socket_path, family="AF_UNIX", authkey=read_authkey(socket_path))
+        self.conn.send({"type": "hello", "model_config": model_config})
+        reply = self.conn.recv()
+        if "error" in reply:
+            self.conn.close()
+            raise ValueError(
+                f"The inference server at {socket_path} has no model with the config {model_config}, "
+                f"it serves {reply['model_configs']}"
+            )
+
+    def predict(self, images):
+        """ The (scores, boxes, image_size) of each image, as returned by Detector._predict """
+        self.conn.send({"type": "predict", "images": list(images)})
+        reply = self.conn.recv()
+        if "error" in reply:
+            raise RuntimeError(f"Inference server error: {reply['error']}")
+        return reply["predictions"]
+
+    def close(self):
+        self.conn.close()
@@ -11,6 +11,7 @@ from roosts.utils.visualizer import Visualizer
 from roosts.utils.postprocess import Postprocess
 from roosts.utils.file_util import delete_files
 from roosts.utils.time_util import scan_key_to_local_time
+from tqdm import tqdm
 
 
 class RoostSystem:
@@ -22,11 +23,17 @@ class RoostSystem:
             download_dir=dirs["scan_dir"], npz_dir=dirs["npz_dir"],
             aws_access_key_id=args.aws_access_key_id,
             aws_secret_access_key=args.aws_secret_access_key,
+            num_workers=args.download_workers,
+        )
+        self.renderer = Renderer(
+            dirs["scan_dir"], dirs["npz_dir"], dirs["ui_img_dir"], num_workers=args.render_workers,
+            combined_rendering=args.combined_rendering,
+            array_format=args.array_format, array_dtype=args.array_dtype,
         )
-        self.renderer = Renderer(dirs["scan_dir"], dirs["npz_dir"], dirs["ui_img_dir"])
         if not args.just_render:
             self.detector = Detector(**det_cfg)
-            self.tracker = Tracker()
+            print(f"Detector cpu config: {self.detector.cpu_config}", flush=True)
+            self.tracker = Tracker(assignment=args.track_assignment)
             self.postprocess = Postprocess(**pp_cfg)
             self.count_cfg = count_cfg
             self.visualizer = Visualizer(sun_activity=self.args.sun_activity)
@@ -58,16 +65,20 @@ class RoostSystem:
         logger.setLevel(logging.DEBUG)
         logger.addHandler(filelog)
 
-        ######################### (1) Download data #########################
-        keys = self.downloader.download_scans(keys, logger)
-        scanname2key = {os.path.splitext(key.split("/")[-1])[0]: key for key in keys}
+        if self.args.pipeline:
+            ######################### (1) & (2) Download and render data in a pipeline #########################
+            keys, (npz_files, scan_names, img_files) = self.download_and_render(keys, logger)
+        else:
+            ######################### (1) Download data #########################
+            keys = self.downloader.download_scans(keys, logger)
 
-        ######################### (2) Render data #########################
-        (
-            npz_files,      # the list of arrays for the detector to load and process
-            scan_names,     # the list of all scans for the tracker to know
-            img_files,      # the list of dz05 images for visualization
-        ) = self.renderer.render(keys, logger)
+            ######################### (2) Render data #########################
+            (
+                npz_files,      # the list of arrays for the detector to load and process
+                scan_names,     # the list of all scans for the tracker to know
+                img_files,      # the list of dz05 images for visualization
+            ) = self.renderer.render(keys, logger)
+        scanname2key = {os.path.splitext(key.split("/")[-1])[0]: key for key in keys}
 
         if len(npz_files) == 0:
             process_end_time = time.time()
@@ -151,7 +162,18 @@ class RoostSystem:
 
         ######################### (3) Run detection models on the data #########################
         detections = self.detector.run(npz_files)
-        logger.info(f'[Detection Done] {len(detections)} detections')
+        for scan_name in scan_names:
+            if scan_name in self.detector.skipped_scans:
+                stats = self.detector.skipped_scans[scan_name]
+                logger.info(
+                    f'[Detection Skipped] scan {scan_name} - '
+                    f'echo fraction {stats["echo_fraction"]:.4f}, rain fraction {stats["rain_fraction"]:.4f}'
+                )
+        logger.info(
+            f'[Detection Done] {len(detections)} detections; '
+            f'{self.detector.num_cached} scans read from the detection cache; '
+            f'{self.detector.input_wait_time:.2f}s waiting for input'
+        )
 
         ######################### (4) Run tracking on the detections #########################
         """
@@ -200,3 +222,36 @@ class RoostSystem:
             f'total time elapse: {process_end_time - process_start_time}'
         )
         print(f"Total time elapse: {process_end_time - process_start_time}\n", flush=True)
+
+    def close(self):
+        """ Release the rendering processes and the inference server connection at the end of the run """
+        self.renderer.close()
+        if not self.args.just_render:
+            self.detector.close()
+
+    def download_and_render(self, keys, logger):
+        """
+            Render each scan as soon as its download completes, overlapping network I/O with rendering.
+            Returns the successfully downloaded keys and (npz_files, scan_names, img_files),
+            all in the order of the input keys, same as download_scans followed by render.
+        """
+        downloaded = [False] * len(keys)
+        downloads = self.downloader.iter_download_scans(keys, logger)
+
+        def downloaded_keys():
+            for idx, key, success in tqdm(downloads, total=len(keys), desc="Downloading"):
+                if success:
+                    downloaded[idx] = True
+                    yield idx, key
+
+        try:
+            rendered = self.renderer.render_stream(downloaded_keys(), logger)
+        finally:
+            downloads.close() # stops the download threads if rendering failed
+        rendered = [rendered[idx] for idx in sorted(rendered)]
+
+        keys = [key for key, success in zip(keys, downloaded) if success]
+        npz_files = [r[0] for r in rendered]
+        scan_names = [r[1] for r in rendered]
+        img_files = [r[2] for r in rendered]
+        return keys, (npz_files, scan_names, img_files)
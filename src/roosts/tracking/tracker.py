@@ -1,6 +1,7 @@
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 from tqdm import tqdm 
-import copy
 from roosts.utils.time_util import scan_key_to_utc_time
 
 
@@ -10,11 +11,14 @@ class Tracker:
             detections =  [{'scanname', 'det_ID', 'det_score', 'im_bbox': ('x', 'y', 'r')}]
         Alg: Greedy algorithm for associating detections across frames, then Kalman filter to smooth the tracking.
             The tracking algorithm uses a lot of heuristics: (1) bird expansion rate (2) time interval between frames.
+            Optionally, the association in each frame is an optimal (Hungarian) assignment instead of greedy.
         Output: tracks
             tracks     =  [{'track_ID', 'det_IDs', 'det_or_pred', 'state': {'mean', 'var'}}]
     """
 
-    def __init__(self, imsize=600):
+    def __init__(self, imsize=600, assignment="greedy"):
+        assert assignment in ["greedy", "hungarian"], f"Unknown assignment {assignment}"
+        self.assignment = assignment
         # Based on our AAAI paper, the dispersion rate is 6.61 m/s, corresponding to 1.59 pixel/min in a 600**2 image
         dispersion_rate = 1.59
         center_velocity = 3
@@ -25,6 +29,9 @@ class Tracker:
             'Q_multiplier': 5, # multiplier in covariance matrix of state transition formula
             'P_multiplier': 1, # multiplier in the initial error covariance matrix
         }
+        # the time-independent matrices of the constant-velocity model, see _kalman_filter
+        self.velocity = np.eye(6, k=3)  # adds the velocities times the time interval to x, y, r
+        self.Q = np.eye(6) * self.params['Q_multiplier']
 
 
     def tracking(self, scans, detections):
@@ -48,21 +55,28 @@ class Tracker:
         # sort the scans based on scan time
         scans.sort(key=lambda x: int(x[4:12] + x[13:19])) # the first 4 characters are radar station name
 
-        # add a new field in detections to indicate whether the det has been tracked
+        # add a new field in detections to indicate whether the det has been tracked,
+        # and index the detections of each scan, in the order of detections
+        scan_dets = {scan: [] for scan in scans}
         for det in detections:
             det['track_ID'] = -1
+            if det['scanname'] in scan_dets:
+                scan_dets[det['scanname']].append(det)
+        # roosts predicted by the physical model when a track has no match in the next frame,
+        # appended to detections after tracking. They are never matched or used to start a track.
+        predictions = []
 
         count_track = 1
         for scan_idx, scan in enumerate(tqdm(scans[:-1], desc="Tracking")): # ignore the last frame
             
             """ (1) start from the first frame, if the detections is not tracked yet, init a track """
-            for det_idx, det in enumerate(detections):
-                if det['scanname'] == scan and det['track_ID'] == -1:
+            for det in scan_dets[scan]:
+                if det['track_ID'] == -1:
                     # start a track
                     # Note: the original implementation only starts a track if the det_score is higher than 0.5 
                     # and the time from the sunrise is smaller than 30 mins for bird roosts,
                     # here we init a track regardless the frame time to get higher recall
-                    detections[det_idx]['track_ID'] = count_track
+                    det['track_ID'] = count_track
 
                     state_mean = np.array([
                         det['im_bbox'][0],  # x
@@ -88,150 +102,176 @@ class Tracker:
 
             """ (3) start from the first track, find the best match in the next frame, apply kalman filter  """
             next_scan = scans[scan_idx+1] 
-            next_dets_idx = [idx for idx, det in enumerate(detections) if det['scanname'] == next_scan]
-            next_dets = np.array(detections)[next_dets_idx]
+            next_dets = scan_dets[next_scan]
             # minute between two scans
             delta_t = scan_key_to_utc_time(next_scan) - scan_key_to_utc_time(scan)
             delta_t = delta_t.total_seconds() / 60
-            for track_idx, track in enumerate(tracks):
-                # find the best match
-                if len(next_dets) == 0: # no detection in the next frame
-                    best_next_idx, best_next_det = None, None
-                else:
-                    best_next_idx, best_next_det = self._find_NN(track['state']['mean'], next_dets, delta_t)  
-
+            if len(tracks) == 0:
+                continue
+            # find the best match of each track
+            matches = self._associate([track['state']['mean'] for track in tracks], next_dets, delta_t)
+            # apply kalman filter to all tracks, which smooths the matched detections
+            # and predicts a roost based on the track state for the tracks without match
+            matched = [track_idx for track_idx, match in enumerate(matches) if match is not None]
+            means, variances, next_bboxes = self._kalman_filter(
+                np.array([track['state']['mean'] for track in tracks]),
+                np.array([track['state']['var'] for track in tracks]),
+                matched,
+                np.array([next_dets[matches[track_idx]]['im_bbox'] for track_idx in matched]).reshape(-1, 3),
+                np.array([next_dets[matches[track_idx]]['det_score'] for track_idx in matched]),
+                delta_t,
+            )
+            for track_idx, (track, best_next_idx) in enumerate(zip(tracks, matches)):
                 if best_next_idx is None:
-                    # if no match found in the next frame, predict one based on the track state 
-                    updated_state, next_bbox = self._kalman_filter(track['state'], None, None, delta_t)
-                    # create a new roost prediction, add it to the list of detections
+                    # if no match found in the next frame, create a new roost prediction,
+                    # with the det_ID it takes once appended to detections
                     roost_pred  =  {
                         'scanname'  : next_scan,
                         'track_ID'  : track['track_ID'],
-                        'det_ID'    : len(detections),
+                        'det_ID'    : len(detections) + len(predictions),
                         'det_score' : -1,
-                        'im_bbox'   : next_bbox
+                        'im_bbox'   : next_bboxes[track_idx]
                     }
-                    detections.append(roost_pred)
+                    predictions.append(roost_pred)
                     # update the state of track
-                    tracks[track_idx]['det_IDs'].append(roost_pred['det_ID'])
-                    tracks[track_idx]['det_or_pred'].append(False)
+                    track['det_IDs'].append(roost_pred['det_ID'])
+                    track['det_or_pred'].append(False)
                 else:
-                    # match found, apply kalman filter to smooth the detection
-                    updated_state, next_bbox = self._kalman_filter(
-                        track['state'], best_next_det['im_bbox'], best_next_det['det_score'], delta_t
-                    )
                     # link the detection to the track, overwrite the original bbox from faster RCNN
-                    detections[next_dets_idx[best_next_idx]]['track_ID'] = track['track_ID']
-                    detections[next_dets_idx[best_next_idx]]['im_bbox'] = next_bbox
+                    best_next_det = next_dets[best_next_idx]
+                    best_next_det['track_ID'] = track['track_ID']
+                    best_next_det['im_bbox'] = next_bboxes[track_idx]
                     # update the state of track
-                    tracks[track_idx]['det_IDs'].append(detections[next_dets_idx[best_next_idx]]['det_ID'])
-                    tracks[track_idx]['det_or_pred'].append(True)
-                tracks[track_idx]['state'] = updated_state
+                    track['det_IDs'].append(best_next_det['det_ID'])
+                    track['det_or_pred'].append(True)
+                track['state'] = {'mean': means[track_idx], 'var': variances[track_idx]}
 
+        detections.extend(predictions)
         detections, tracks = self.NMS_tracks(detections, tracks)
         detections, tracks = self.merge_tracks(detections, tracks)
         
         return detections, tracks
 
 
-    def _find_NN(self, track_state, next_dets, t):
+    def _gate(self, track_states, next_dets, t):
         """ 
-            Find the nearest detections in the next frame 
+            Distances between tracks and detections in the next frame, and whether they may be matched
 
             Args: 
-                track_state:    x, y, r, v_x, v_y, v_r
+                track_states:   (num_tracks, 6) array of x, y, r, v_x, v_y, v_r
                 next_dets:      detections in the next frame
                 t:              time interval between adjacent frames
 
             Return:
-                the best not-yet-matched detections in the next frame
+                (num_tracks, num_dets) arrays of center distances and of matchable pairs
         """
 
-        x, y, r = track_state[:3]
-        center_dist = []
-        r_change = []
-        for idx, next_det in enumerate(next_dets):
-            xx, yy, rr = next_det['im_bbox']
-            if next_det['track_ID'] == -1:
-                center_dist.append(np.sqrt((xx-x) ** 2 + (yy-y) ** 2))
-                r_change.append(rr - r)
-            else: # this detection has been tracked
-                center_dist.append(np.inf)
-                r_change.append(np.inf)
-
-        center_dist, r_change = np.array(center_dist), np.array(r_change)
+        x, y, r = track_states[:, 0:1], track_states[:, 1:2], track_states[:, 2:3]
+        bboxes = np.array([next_det['im_bbox'] for next_det in next_dets])
+        xx, yy, rr = bboxes[:, 0], bboxes[:, 1], bboxes[:, 2]
+        center_dist = np.sqrt((xx - x) ** 2 + (yy - y) ** 2)
+        r_change = rr - r
         # Here are some heuristics to find the best match, however, no rigorous ablation study is done to verify
         # whether each of them are optimal or necessary, it works in practice anyway.
         # (1) the distance should be less than 1.5 *  * time_interval
         # (2) change in radius should be less than 2 * dispersion_rate * time_interval
         # (3) signed change in radius should be higher than -0.1 * radius
         # NOTE: these conditions are very empirical and may be only suboptimal
-        match_list = np.where((
+        gate = (
                 (r_change <= self.params['radius_velocity'] * 2 * t) &  # should not expand too much
                 (r_change > -0.1 * r) &  # roost should not shrink too much
                 (center_dist < self.params['center_velocity'] * 1.5 * t)  # should not move too far
-        ))[0]
-        if len(match_list) == 0: # no match found
-            return None, None
-        best_match_idx = match_list[np.argsort(center_dist[match_list])[0]]
-        return best_match_idx, next_dets[best_match_idx]
+        )
+        # detections already tracked cannot be matched
+        gate &= np.array([next_det['track_ID'] == -1 for next_det in next_dets])
+        return center_dist, gate
 
 
-    def _kalman_filter(self, track_state, det_bbox, det_score, t):
+    def _associate(self, track_states, next_dets, t):
+        """ 
+            Match tracks to detections in the next frame
+
+            Args: 
+                track_states:   x, y, r, v_x, v_y, v_r of each track
+                next_dets:      detections in the next frame
+                t:              time interval between adjacent frames
+
+            Return:
+                for each track, the index of its match in next_dets, None if no match found
+                greedy:    in the order of tracks, each track takes the nearest detection not taken yet
+                hungarian: the most tracks are matched, with the lowest total center distance
+        """
+
+        matches = [None] * len(track_states)
+        if len(track_states) == 0 or len(next_dets) == 0:
+            return matches
+        center_dist, gate = self._gate(np.array(track_states), next_dets, t)
+
+        if self.assignment == "greedy":
+            available = np.ones(len(next_dets), dtype=bool)
+            for track_idx in np.flatnonzero(gate.any(axis=1)):
+                match_list = np.flatnonzero(gate[track_idx] & available)
+                if len(match_list) == 0: # no match found
+                    continue
+                best_match_idx = match_list[np.argsort(center_dist[track_idx, match_list])[0]]
+                available[best_match_idx] = False
+                matches[track_idx] = best_match_idx
+        else:
+            # only tracks and detections with a possible match take part, and pairs that cannot be matched
+            # cost more than all possible matches together, so the assignment has the most matches first
+            track_idxs, det_idxs = np.flatnonzero(gate.any(axis=1)), np.flatnonzero(gate.any(axis=0))
+            sub_gate = gate[np.ix_(track_idxs, det_idxs)]
+            sub_dist = center_dist[np.ix_(track_idxs, det_idxs)]
+            cost = np.where(sub_gate, sub_dist, sub_dist[sub_gate].sum() + 1)
+            for row, col in zip(*linear_sum_assignment(cost)):
+                if gate[track_idxs[row], det_idxs[col]]:
+                    matches[track_idxs[row]] = det_idxs[col]
+        return matches
+
+
+    def _kalman_filter(self, means, variances, matched, det_bboxes, det_scores, t):
         """ 
-            Given the current state of the track (e.g., position, velocity), 
-            and the best detection matched in the next frame, update the state of the track
+            Given the current states of the tracks (e.g., position, velocity), 
+            and the best detections matched in the next frame, update the states of the tracks
 
             Args:
-                track_state: the state of the track in the current frame np.array([x, y, r, v_x, v_y, v_r])
-                det_bbox   : the best match of the track in the next frame
-                det_score  : the detection score of the best match 
+                means      : (num_tracks, 6) states of the tracks in the current frame [x, y, r, v_x, v_y, v_r]
+                variances  : (num_tracks, 6, 6) error covariance matrices of the states
+                matched    : indices of the tracks with a match in the next frame
+                det_bboxes : (num_matched, 3) the best matches of these tracks in the next frame
+                det_scores : (num_matched,) the detection scores of the best matches
                 t          : the time interval between the two frames
             
             Return:
-                updated state of track
+                updated means and variances of the tracks, and their (num_tracks, 3) bboxes in the next frame
                 
             This implementation of Kalman filter is based on: 
                     http://web.mit.edu/kirtley/kirtley/binlustuff/literature/control/Kalman%20filter.pdf
+            The caffe version computed P = (P_prior^-1 + H^T R^-1 H)^-1 and K = P H^T R^-1, which are the same as
+            the common formula K = P_prior H^T S^-1, P = P_prior - K H P_prior with S = H P_prior H^T + R.
+            The latter only solves a linear system of the 3x3 matrix S instead of inverting 6x6 matrices.
         """
 
-        Phi = np.array([[1,0,0,t,0,0],    # x + x_v * t: new x position of roost center
-                      [0,1,0,0,t,0],    # y + y_v * t: new y position of roost center
-                      [0,0,1,0,0,t],    # r + r_v * t: new roost radius 
-                      [0,0,0,1,0,0],    # constant x_v: velocity of roost center in x axis
-                      [0,0,0,0,1,0],    # constant y_v: velocity of roost center in y axis
-                      [0,0,0,0,0,1]])   # constant r_v: expansion rate of roost radius
-        Q = np.eye(6) * self.params['Q_multiplier'] # covariance matrix of noise in state projection formula
-        H = np.eye(3, 6)                # H.dot(state) extracts (x, y, r): connection between state and measurement
-
-        X_prev = track_state['mean']    # state at k-th step
-        P_prev = track_state['var']     # error covariance matrix at k-th step
-        X = Phi.dot(X_prev)               # state projection to (k+1)-th step
-        P_prior = Phi.dot(P_prev).dot(Phi.T) + Q  # error covariance matrix at (k+1)-th step
-
-        if det_bbox is None:
-            # if no detection to be tracked in the next frame, return the prediction from constant-velocity model
-            P = P_prior
-        else:
-            # otherwise, smooth using Kalman filter
+        # state projection to (k+1)-th step with Phi = I + t * velocity, the constant-velocity model
+        Phi = np.eye(6) + t * self.velocity
+        X = means.dot(Phi.T)
+        P = Phi.dot(variances).transpose(1, 0, 2).dot(Phi.T) + self.Q  # Phi P Phi^T + Q of each track
+
+        # if no detection to be tracked in the next frame, keep the prediction from constant-velocity model,
+        # otherwise, smooth using Kalman filter
+        if len(matched) > 0:
+            P_prior = P[matched]
             # R is the covairance matrix of noise in measurement, here I assume it is correlated to det score
-            R = np.eye(3) + self.params['R_multiplier'] * np.eye(3) * (1 - det_score)
-            # Kalman Gain
-            P_prior_inv = np.linalg.inv(P_prior)
-            R_inv = np.linalg.inv(R)
-            P = np.linalg.inv(P_prior_inv + H.T.dot(R_inv).dot(H))
-            K = P.dot(H.T).dot(R_inv)
-            # below is the most common Kalman filter formula, not sure where the above formula from in caffe version
-            # the Kalman gain is equivalent, but the P is different, I believe below should be right
-            # but the above also works in practice, anyway 
-            '''
-            K = P_prior.dot(H.T).dot(np.linalg.inv(H.dot(P_prior).dot(H.T) + R))
-            P = (1 - K.dot(H)).dot(P_prior)
-            '''
+            R = 1 + self.params['R_multiplier'] * (1 - det_scores).astype(np.float64)
+            # H extracts (x, y, r) from the state, so H P_prior H^T and H P_prior are slices of P_prior
+            S = P_prior[:, :3, :3] + R[:, np.newaxis, np.newaxis] * np.eye(3)
+            # Kalman Gain, K^T = S^-1 H P_prior since S and P_prior are symmetric
+            K = np.linalg.solve(S, P_prior[:, :3, :]).transpose(0, 2, 1)
             # Linear equation
-            X = X + K.dot(det_bbox - H.dot(X))
+            X[matched] += np.einsum('nij,nj->ni', K, det_bboxes - X[matched, :3])
+            P[matched] = P_prior - K @ P_prior[:, :3, :]
 
-        return {'mean': X, 'var': P}, H.dot(X)
+        return X, P, X[:, :3].copy()
 
 
     def _is_det_overlapped(self, bbox1, bbox2):
@@ -240,6 +280,22 @@ class Tracker:
         return np.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2) < max(r1, r2)
 
 
+    def _tracks_near(self, bbox, scan_idx, tracks, det_dict, start_tracks, start_index):
+        """
+            Positions of the tracks starting in a scan whose first det may overlap bbox, a superset found by
+            a KD-tree of the first dets of the scan, which is built the first time the scan is queried
+        """
+        if scan_idx not in start_tracks:
+            return []
+        if scan_idx not in start_index:
+            bboxes = np.array([det_dict[tracks[j]["det_IDs"][0]]["im_bbox"] for j in start_tracks[scan_idx]])
+            start_index[scan_idx] = (cKDTree(bboxes[:, :2]), bboxes[:, 2].max())
+        tree, max_radius = start_index[scan_idx]
+        # overlapped dets are closer than the larger radius, with a margin for bboxes in float32
+        radius = max(bbox[2], max_radius, 0) * (1 + 1e-6) + 1e-6
+        return [start_tracks[scan_idx][idx] for idx in tree.query_ball_point(np.asarray(bbox[:2]), radius)]
+
+
     def NMS_tracks(self, detections, tracks):
         """
             Apply Non-Maximum Suppression on the tracks 
@@ -262,23 +318,36 @@ class Tracker:
 
         # (2) start from the first tracks, measure its overlap with other tracks
         # get the dets from track1 and from track2, measure the overlap, if higher than a thresh, overlap+1
-        # for i, track_i in enumerate(tqdm(tracks, desc="NMS on tracks")):
-        for i, track_i in enumerate(tracks):
-            for j, track_j in enumerate(tracks[i+1:]):
-                cooccur_num = 0  # number of co-occurred frames
-                overlap_dets = 0 # number of overlapped detections
-                for det_ID_i in track_i["det_IDs"]:
-                    for det_ID_j in track_j["det_IDs"]:
-                        if ((det_dict[det_ID_i]["scanname"] == det_dict[det_ID_j]["scanname"]) and
-                            (det_dict[det_ID_i]["det_score"] != -1) and  # score=-1: bbox is from Kalman filter
-                            (det_dict[det_ID_j]["det_score"] != -1)):
-
-                            cooccur_num += 1
-                            if self._is_det_overlapped(det_dict[det_ID_i]["im_bbox"], 
-                                                       det_dict[det_ID_j]["im_bbox"]):
-                                overlap_dets += 1
-                if cooccur_num != 0 and (overlap_dets / cooccur_num >= 0.5):
-                    track_j["NMS_suppressed"] = True
+        # group the dets of the tracks by scan, and count the dets of each track in each scan
+        scan_dets = {}
+        track_scans = []
+        for i, track in enumerate(tracks):
+            scan_counts = {}
+            for det_ID in track["det_IDs"]:
+                det = det_dict[det_ID]
+                if det["det_score"] != -1:  # score=-1: bbox is from Kalman filter
+                    scan_dets.setdefault(det["scanname"], []).append((i, det))
+                    scan_counts[det["scanname"]] = scan_counts.get(det["scanname"], 0) + 1
+            track_scans.append(scan_counts)
+
+        # only pairs of tracks with overlapped dets may be suppressed, they are found with a spatial index per scan:
+        # overlapped dets are closer than the largest radius in the scan
+        overlap_dets = {}  # (i, j) -> number of overlapped dets of track i and track j, i < j
+        for dets in scan_dets.values():
+            if len(dets) < 2:
+                continue
+            bboxes = np.array([det["im_bbox"] for _, det in dets], dtype=np.float64)
+            max_radius = max(bboxes[:, 2].max(), 0) * (1 + 1e-6) + 1e-6  # margin for bboxes in float32
+            for a, b in cKDTree(bboxes[:, :2]).query_pairs(max_radius):
+                (i, det_i), (j, det_j) = sorted((dets[a], dets[b]), key=lambda x: x[0])
+                if i != j and self._is_det_overlapped(det_i["im_bbox"], det_j["im_bbox"]):
+                    overlap_dets[(i, j)] = overlap_dets.get((i, j), 0) + 1
+
+        for (i, j), overlap_num in overlap_dets.items():
+            # number of co-occurred frames
+            cooccur_num = sum(num * track_scans[j].get(scan, 0) for scan, num in track_scans[i].items())
+            if cooccur_num != 0 and (overlap_num / cooccur_num >= 0.5):
+                tracks[j]["NMS_suppressed"] = True
         
         for track in tracks:
             for det_ID in track["det_IDs"]:
@@ -318,6 +387,12 @@ class Tracker:
         for scan_idx, scan in enumerate(scans):
             scan_dict[scan] = scan_idx
 
+        # index the tracks by the scan of their first det, with a spatial index of these first dets built on demand
+        start_tracks = {}  # scan index -> positions of the tracks starting in the scan, in increasing order
+        for j, track in enumerate(tracks):
+            start_tracks.setdefault(scan_dict[det_dict[track["det_IDs"][0]]["scanname"]], []).append(j)
+        start_index = {}  # scan index -> (KD-tree of the centers of the first dets, their largest radius)
+
         # (2) start from the first tracks, measure its overlap with other tracks
         # get the last det from track1 and the first det from track2, measure the overlap,
         # if higher than a thresh, merge
@@ -328,7 +403,8 @@ class Tracker:
                 continue
             else:
                 track_i["merged"] = True
-                new_track = copy.deepcopy(track_i)
+                # the lists of the new track are replaced when merging, the rest is shared with track_i
+                new_track = dict(track_i)
 
             # get the last det
             for k in range(len(track_i["det_or_pred"]) - 1, -1, -1):
@@ -337,28 +413,43 @@ class Tracker:
                     break
             last_det_i = det_dict[track_i["det_IDs"][last_det_idx]]
 
-            for j, track_j in enumerate(tracks[i + 1:]):
-                if track_j["merged"]:
-                    continue
-                # get the first det
-                first_det_j = det_dict[track_j["det_IDs"][0]]
-                # the tracks to be merged is not overlapped
-                frame_gap = scan_dict[first_det_j["scanname"]] - scan_dict[last_det_i["scanname"]]
-                if (frame_gap > 0) and (frame_gap < 3):
+            # the later tracks are considered in order, starting after the last merged one
+            j = i
+            while True:
+                # only tracks starting 1 or 2 frames after the last det may be merged,
+                # i.e. the tracks to be merged do not overlap in time
+                last_scan_idx = scan_dict[last_det_i["scanname"]]
+                candidates = []
+                for frame_gap in (1, 2):
+                    near = self._tracks_near(
+                        last_det_i["im_bbox"], last_scan_idx + frame_gap, tracks, det_dict, start_tracks, start_index
+                    )
+                    candidates.extend(k for k in near if k > j and not tracks[k]["merged"])
+                candidates.sort()
+
+                for k in candidates:
+                    # get the first det
+                    first_det_j = det_dict[tracks[k]["det_IDs"][0]]
                     if self._is_det_overlapped(first_det_j["im_bbox"], last_det_i["im_bbox"]):
-                        track_j["merged"] = True
-                        merge_range = last_det_idx + frame_gap
-                        new_track["det_IDs"] = new_track["det_IDs"][:merge_range] + track_j["det_IDs"]
-                        new_track["det_or_pred"] = new_track["det_or_pred"][:merge_range] + track_j["det_or_pred"]
-                        # get the last det
-                        for k in range(len(new_track["det_or_pred"]) - 1, -1, -1):
-                            if new_track["det_or_pred"][k]:
-                                last_det_idx = k
-                                break
-                        last_det_i = det_dict[new_track["det_IDs"][last_det_idx]]
-                        # modify the track ID of the bboxes in a track
-                        for det_ID in new_track["det_IDs"][merge_range:]:
-                            det_dict[det_ID]["track_ID"] = new_track["track_ID"]
+                        break
+                else:
+                    break # no more track to merge
+
+                j, track_j = k, tracks[k]
+                frame_gap = scan_dict[first_det_j["scanname"]] - last_scan_idx
+                track_j["merged"] = True
+                merge_range = last_det_idx + frame_gap
+                new_track["det_IDs"] = new_track["det_IDs"][:merge_range] + track_j["det_IDs"]
+                new_track["det_or_pred"] = new_track["det_or_pred"][:merge_range] + track_j["det_or_pred"]
+                # get the last det
+                for k in range(len(new_track["det_or_pred"]) - 1, -1, -1):
+                    if new_track["det_or_pred"][k]:
+                        last_det_idx = k
+                        break
+                last_det_i = det_dict[new_track["det_IDs"][last_det_idx]]
+                # modify the track ID of the bboxes in a track
+                for det_ID in new_track["det_IDs"][merge_range:]:
+                    det_dict[det_ID]["track_ID"] = new_track["track_ID"]
             new_tracks.append(new_track)
 
         return detections, new_tracks
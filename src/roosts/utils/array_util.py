@@ -0,0 +1,151 @@
+"""
+Storage of rendered arrays.
+
+A rendered scan holds "array" and optionally "dualpol_array". They can be saved as
+    npz_compressed: {scan}.npz with zlib at the default level, the original format
+    npz_fast:       {scan}.npz with zlib at level 1, much faster to write and still readable by np.load
+    npz:            {scan}.npz without compression
+    npy:            {scan}.npy for "array" and {scan}.dualpol.npy for "dualpol_array", uncompressed and
+                    memory-mappable so that readers only touch the bytes they use
+and optionally downcast to float32 or float16. Readers detect the format from the file extension,
+so previously rendered npz archives keep working.
+RenderedScan gives lazy access to single (field, elevation) channels, so that consumers only read what they use.
+"""
+
+import os
+import zipfile
+import numpy as np
+
+ARRAY_FORMATS = {
+    "npz_compressed":   ".npz",
+    "npz_fast":         ".npz",
+    "npz":              ".npz",
+    "npy":              ".npy",
+}
+ARRAY_DTYPES = [None, "float64", "float32", "float16"]  # None keeps the dtype from rendering
+
+# layout of rendered arrays, see ARRAY_RENDER_CONFIG and DUALPOL_RENDER_CONFIG in roosts.data.renderer
+ARRAY_FIELDS        = ["reflectivity", "velocity", "spectrum_width"]
+ARRAY_ELEVATIONS    = [0.5, 1.5, 2.5, 3.5, 4.5]
+DUALPOL_FIELDS      = ["differential_reflectivity", "cross_correlation_ratio", "differential_phase"]
+DUALPOL_ELEVATIONS  = [0.5, 1.5, 2.5, 3.5, 4.5]
+
+
+def _dualpol_npy_path(path):
+    return f"{os.path.splitext(path)[0]}.dualpol.npy"
+
+
+def get_array_path(path_without_ext, array_format="npz_compressed"):
+    return f"{path_without_ext}{ARRAY_FORMATS[array_format]}"
+
+
+def find_array_file(path_without_ext):
+    """ Return the path of the rendered arrays of a scan in any format, or None if not rendered """
+    for ext in [".npz", ".npy"]:
+        if os.path.exists(f"{path_without_ext}{ext}"):
+            return f"{path_without_ext}{ext}"
+    return None
+
+
+def save_arrays(path_without_ext, arrays, array_format="npz_compressed", dtype=None):
+    """
+        Save {name: array} of a scan in the given format, return the path to be passed to load_arrays.
+    """
+    assert array_format in ARRAY_FORMATS, f"Unknown array format {array_format}"
+    if dtype is not None:
+        arrays = {name: array.astype(dtype) for name, array in arrays.items()}
+
+    path = get_array_path(path_without_ext, array_format)
+    if array_format == "npz_compressed":
+        np.savez_compressed(path, **arrays)
+    elif array_format == "npz":
+        np.savez(path, **arrays)
+    elif array_format == "npz_fast":
+        with zipfile.ZipFile(path, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for name, array in arrays.items():
+                with zf.open(f"{name}.npy", mode="w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+    elif array_format == "npy":
+        np.save(path, arrays["array"])
+        if "dualpol_array" in arrays:
+            np.save(_dualpol_npy_path(path), arrays["dualpol_array"])
+        elif os.path.exists(_dualpol_npy_path(path)):
+            os.remove(_dualpol_npy_path(path))
+    return path
+
+
+def _open_arrays(path):
+    """
+        Open the rendered arrays of a scan saved in any format as a dict-like {name: array}:
+        an open NpzFile whose members are decompressed on access, or memory-mapped npy files.
+    """
+    if path.endswith(".npy"):
+        arrays = {"array": np.load(path, mmap_mode="r")}
+        if os.path.exists(_dualpol_npy_path(path)):
+            arrays["dualpol_array"] = np.load(_dualpol_npy_path(path), mmap_mode="r")
+        return arrays
+    return np.load(path)
+
+
+def load_arrays(path, names=None):
+    """
+        Load the rendered arrays of a scan saved in any format, return {name: array} for the given names
+        (all by default). npy files are memory-mapped; use RenderedScan to read single channels of npz files.
+    """
+    if path.endswith(".npy"):
+        arrays = _open_arrays(path)
+        return {name: arrays[name] for name in arrays if names is None or name in names}
+    with np.load(path) as f:
+        return {name: f[name] for name in f.files if names is None or name in names}
+
+
+class RenderedScan:
+    """
+        Lazy (field, elevation) access to the rendered arrays of a scan.
+        With npy storage, each channel is read from a memory map, i.e. only its bytes are touched;
+        with npz storage, a member ("array" or "dualpol_array") is decompressed on first access and kept.
+        The npz file stays open until close(), so use it as a context manager.
+    """
+
+    def __init__(
+            self,
+            path,
+            fields=ARRAY_FIELDS,
+            elevations=ARRAY_ELEVATIONS,
+            dualpol_fields=DUALPOL_FIELDS,
+            dualpol_elevations=DUALPOL_ELEVATIONS,
+    ):
+        self.path = path
+        self.layout = {
+            "array": (fields, elevations),
+            "dualpol_array": (dualpol_fields, dualpol_elevations),
+        }
+        self._arrays = _open_arrays(path)
+        self._loaded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def has_dualpol(self):
+        return "dualpol_array" in self._arrays
+
+    def _member(self, name):
+        if name not in self._loaded:
+            self._loaded[name] = self._arrays[name]
+        return self._loaded[name]
+
+    def get(self, field, elevation):
+        """ The 2D channel of a field at an elevation, in the geographic direction (row 0 is South) """
+        for name, (fields, elevations) in self.layout.items():
+            if field in fields:
+                return np.asarray(self._member(name)[fields.index(field), elevations.index(elevation)])
+        raise KeyError(f"Unknown field {field}")
+
+    def close(self):
+        if hasattr(self._arrays, "close"):
+            self._arrays.close()
+        self._loaded = {}
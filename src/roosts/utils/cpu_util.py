@@ -0,0 +1,35 @@
+import os
+import torch
+
+
+def parse_cpu_list(cpus):
+    """ Parse a list of cpu ids such as "0-3,8,10-11", as in taskset, into a sorted list of ints """
+    cpu_ids = set()
+    for part in cpus.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpu_ids.update(range(int(first), int(last) + 1))
+        elif part.strip():
+            cpu_ids.add(int(part))
+    return sorted(cpu_ids)
+
+
+def configure_cpu_threads(num_threads=None, num_interop_threads=None, cpu_affinity=None):
+    """
+        Set torch intra-op threads (e.g. within a convolution) and inter-op threads (across independent ops),
+        and optionally pin the process to a list of cpu ids. None keeps the current setting.
+        Environment variables such as OMP_NUM_THREADS are only read when libraries load, so setting them
+        from a running process has no effect; torch.set_num_threads covers both OpenMP and MKL used by torch.
+        Inter-op threads can only be set once per process, before any inter-op parallel work has started.
+    """
+    if cpu_affinity is not None:
+        os.sched_setaffinity(0, cpu_affinity)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads and torch.get_num_interop_threads() != num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    return {
+        "num_threads": torch.get_num_threads(),
+        "num_interop_threads": torch.get_num_interop_threads(),
+        "cpu_affinity": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+    }
@@ -6,6 +6,7 @@ import pickle
 from sklearn.neighbors import NearestNeighbors
 from roosts.utils.geo_util import geo_dist_km, get_roost_coor
 from roosts.utils.time_util import scan_key_to_utc_time
+from roosts.utils.array_util import RenderedScan
 from tqdm import tqdm
 
 
@@ -184,14 +185,15 @@ class Postprocess():
         if self.clean_rain:
             dualpol_data = {}
             for scanname, npz_file in scan_dict.items():
-                radar_data = np.load(npz_file)
-                if "dualpol_array" in radar_data.files:
-                    dualpol = radar_data["dualpol_array"]
-                    dualpol = dualpol[1, 0, ::-1, :]
+                with RenderedScan(npz_file) as radar_data:
+                    if radar_data.has_dualpol:
+                        dualpol = radar_data.get("cross_correlation_ratio", 0.5)
+                        dualpol = np.array(dualpol[::-1, :], dtype=float)
                             # use correlation coefficient at the lowest elevation
                             # flip the y axis, from geographical (y axis starts with North) to image (big y means lower)
-                else:
-                    dualpol = None
+                            # copy as float since _is_there_rain modifies it in place
+                    else:
+                        dualpol = None
                 dualpol_data[scanname] = dualpol
 
             for track in tqdm(tracks, desc="Cleaning rain"):
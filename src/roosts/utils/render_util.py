@@ -0,0 +1,143 @@
+"""
+Nearest-neighbor Cartesian rendering that shares the polar-to-Cartesian mapping across fields.
+
+wsrlib.radar2mat builds an interpolant and looks up every output pixel once per field and sweep, although with
+interp_method="nearest" the pixel -> (ray, gate) mapping of a sweep does not depend on the field.
+NearestMapping follows radar2mat (coords="cartesian", interp_method="nearest") to compute that mapping once
+per sweep, after which every field is rendered by a single gather.
+The heading and range of each output pixel do not depend on the scan and are computed once per process; the
+mapping itself is not cached across scans, since ray azimuths and the mean elevation used for ground range
+jitter from scan to scan and the mapping must equal the one of radar2mat.
+"""
+
+import functools
+import numpy as np
+from scipy.interpolate import interp1d
+from wsrlib import slant2ground
+
+# render config entries that define the geometry of a rendering, i.e. everything except the fields
+GEOMETRY_KEYS = [
+    "ydirection", "coords", "r_min", "r_max", "r_res", "az_res", "dim", "sweeps", "elevs",
+    "use_ground_range", "interp_method",
+]
+
+
+def get_geometry(render_config):
+    return {k: render_config[k] for k in GEOMETRY_KEYS if k in render_config}
+
+
+def is_shared_nearest_geometry(*render_configs):
+    """ Whether the render configs can be rendered together through one NearestMapping """
+    geometries = [get_geometry(config) for config in render_configs]
+    return (
+        all(geometry == geometries[0] for geometry in geometries[1:])
+        and geometries[0].get("coords") == "cartesian"
+        and geometries[0].get("interp_method") == "nearest"
+    )
+
+
+def nearest_index(grid, x):
+    """
+        Nearest grid index of each query point, following scipy's RegularGridInterpolator with method="nearest":
+        ties go to the lower index, points outside [grid[0], grid[-1]] are marked invalid.
+    """
+    i = np.searchsorted(grid, x) - 1
+    np.clip(i, 0, grid.size - 2, out=i)
+    norm_dist = (x - grid[i]) / (grid[i + 1] - grid[i])
+    idx = np.where(norm_dist <= .5, i, i + 1)
+    valid = (x >= grid[0]) & (x <= grid[-1])
+    return idx, valid
+
+
+@functools.lru_cache(maxsize=4)
+def cartesian_query_points(r_max, dim, ydirection):
+    """ Compass heading (PHI) and range (R) of each output pixel """
+    x = y = np.linspace(-r_max, r_max, dim)
+    if ydirection == "xy":
+        X, Y = np.meshgrid(x, y)
+    elif ydirection == "ij":
+        X, Y = np.meshgrid(x, -y)
+    else:
+        raise ValueError("ydirection must be 'xy' or 'ij'")
+    R = np.sqrt(X ** 2 + Y ** 2)
+    PHI = np.mod(np.rad2deg(np.pi / 2 - np.arctan2(Y, X)), 360)
+    return PHI, R
+
+
+def get_unique_sweeps(radar):
+    """ Sorted unique elevation angles and, for each of them, the index of the last sweep at that angle """
+    fixed_angles = radar.fixed_angle["data"]
+    unique_elevs, inverse = np.unique(fixed_angles, return_inverse=True)
+    sweeps = np.array([np.where(inverse == k)[0][-1] for k in range(len(unique_elevs))])
+    return sweeps, unique_elevs
+
+
+class NearestMapping:
+    """
+        Pixel -> (ray, gate) mapping of a Cartesian nearest-neighbor rendering for the sweeps selected by elevs
+        (or sweeps), with the same arguments as wsrlib.radar2mat.
+    """
+
+    def __init__(
+            self,
+            radar,
+            r_max=150000.0,
+            dim=600,
+            sweeps=None,
+            elevs=np.linspace(0.5, 4.5, 5),
+            use_ground_range=True,
+            ydirection="xy",
+            **unused_geometry,      # r_min, r_res, az_res only matter for polar rendering
+    ):
+        unique_sweeps, available_elevs = get_unique_sweeps(radar)
+        if sweeps is None:
+            if elevs is not None:
+                # map each requested elevation to the nearest available elevation
+                inds = np.arange(len(available_elevs))
+                elev2ind = interp1d(available_elevs, inds, kind="nearest", fill_value="extrapolate")
+                sweeps = elev2ind(elevs).astype(int)
+            else:
+                sweeps = np.arange(len(available_elevs))
+
+        x = y = np.linspace(-r_max, r_max, dim)
+        self.shape = (len(sweeps), dim, dim)
+        self.y, self.x = y, x
+        self.rays = np.empty(self.shape, dtype=np.int64)     # ray index into radar.fields[field]["data"]
+        self.gates = np.empty(self.shape, dtype=np.int64)    # gate index into radar.fields[field]["data"]
+        self.valid = np.empty(self.shape, dtype=bool)        # False where the pixel is out of range
+
+        for i, sweep_idx in enumerate(sweeps):
+            sweep = unique_sweeps[sweep_idx]
+            ray_start = radar.sweep_start_ray_index["data"][sweep]
+            az = radar.get_azimuth(sweep)
+            rng = radar.range["data"]
+
+            # sort rays by azimuth and replicate the first and last rays on the opposite ends to handle wrapping
+            order = np.argsort(az)
+            order = np.hstack((order[-1], order, order[0]))
+            sorted_az = az[order[1:-1]]
+            sorted_az = np.hstack((sorted_az[-1] - 360, sorted_az, sorted_az[0] + 360))
+            if np.any(np.diff(sorted_az) <= 0) or np.any(np.diff(rng) <= 0):
+                # radar2mat's RegularGridInterpolator rejects such sweeps rather than picking one of the rays
+                raise ValueError("azimuths and ranges of sweep %d must be strictly ascending" % sweep)
+            elevation = np.mean(radar.get_elevation(sweep))
+            if use_ground_range:
+                rng, _ = slant2ground(rng, elevation)
+
+            PHI, R = cartesian_query_points(r_max, dim, ydirection)
+            pos, az_valid = nearest_index(sorted_az, PHI)
+            gates, rng_valid = nearest_index(rng, R)
+            valid = az_valid & rng_valid
+            self.rays[i] = ray_start + order[pos]
+            self.gates[i] = gates
+            self.valid[i] = valid
+
+    def gather(self, radar, fields):
+        """ Render fields as an array of shape (len(fields), n_sweeps, dim, dim), NaN where there is no data """
+        data = np.full((len(fields),) + self.shape, np.nan)
+        for f, field in enumerate(fields):
+            if field not in radar.fields:
+                raise ValueError("field %s is not available" % field)
+            values = np.ma.asarray(radar.fields[field]["data"])[self.rays[self.valid], self.gates[self.valid]]
+            data[f][self.valid] = np.ma.filled(values.astype(float), np.nan)
+        return data
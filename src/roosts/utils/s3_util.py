@@ -1,9 +1,18 @@
 import boto3
 import botocore
+import numpy as np
+from botocore.config import Config
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
 import re
 import os
 import pytz
+import threading
+
+NEXRAD_BUCKET = 'noaa-nexrad-level2'
+NEXRAD_REGION = 'us-east-2'
+S3_MAX_POOL_CONNECTIONS = 32  # should be no less than the number of concurrent downloads
+KEY_CACHE_MARGIN_DAYS = 2  # UTC days this recent may still receive late scans and are not cached
 
 ####################################
 # Helpers
@@ -76,11 +85,165 @@ def parse_key(key):
     t = datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
     return pytz.utc.localize(t), station
 
+def parse_key_times(keys):
+    """Parse the timestamps of many keys at once
+
+    Args:
+        keys (list): s3 keys in the format of yyyy/mm/dd/ssss/ssssyyyymmdd_hhmmss*
+
+    Returns:
+        np.ndarray: int64 microseconds since the epoch (UTC), in the order of keys
+    """
+    timestamps = [os.path.basename(key)[4:19] for key in keys]
+    times = np.array(
+        [f'{t[:4]}-{t[4:6]}-{t[6:8]}T{t[9:11]}:{t[11:13]}:{t[13:15]}' for t in timestamps],
+        dtype='datetime64[us]'
+    )
+    return times.astype(np.int64)
+
+def to_epoch_us(t):
+    """Convert a timezone-aware datetime to int microseconds since the epoch"""
+    return (t - datetime(1970, 1, 1, tzinfo=pytz.utc)) // timedelta(microseconds=1)
+
 
 ####################################
 # AWS setup
 ####################################
 
+# S3 clients are thread-safe and hold a keep-alive connection pool,
+# so one client per (credentials, region) is shared by the whole process
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+_s3_stats = {"clients_created": 0, "client_requests": 0, "http_requests": 0}
+
+
+def _count_http_request(**kwargs):
+    with _s3_clients_lock:
+        _s3_stats["http_requests"] += 1
+
+
+def get_s3_client(aws_access_key_id=None, aws_secret_access_key=None, region_name=NEXRAD_REGION):
+    """Get the process-wide S3 client for the given credentials and region, create it if necessary"""
+    cache_key = (aws_access_key_id, aws_secret_access_key, region_name)
+    with _s3_clients_lock:
+        _s3_stats["client_requests"] += 1
+        client = _s3_clients.get(cache_key)
+        if client is None:
+            config = Config(
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+            )
+            if aws_access_key_id is None and aws_secret_access_key is None:
+                session = boto3.session.Session()
+            else:
+                session = boto3.session.Session(
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                )
+            client = session.client('s3', region_name=region_name, config=config)
+            client.meta.events.register('request-created.s3', _count_http_request)
+            _s3_clients[cache_key] = client
+            _s3_stats["clients_created"] += 1
+    return client
+
+
+def get_s3_client_stats():
+    """Report how much session setup and connection establishment the shared S3 clients saved
+
+    Returns:
+        dict: clients_created, client_requests, http_requests, plus
+            sessions_saved: client lookups served from the cache instead of constructing a new session/client
+            connections_saved: lower bound of TCP/TLS handshakes avoided by keep-alive connection reuse,
+                i.e. HTTP requests beyond what a full pool of fresh connections per client could serve
+    """
+    with _s3_clients_lock:
+        stats = dict(_s3_stats)
+    stats["sessions_saved"] = stats["client_requests"] - stats["clients_created"]
+    stats["connections_saved"] = max(
+        0, stats["http_requests"] - stats["clients_created"] * S3_MAX_POOL_CONNECTIONS
+    )
+    return stats
+
+
+def list_station_day_keys(
+        day,
+        station,
+        aws_access_key_id=None,
+        aws_secret_access_key=None,
+):
+    """List all scan keys of a station on a UTC day with a single paginated prefix scan
+
+    Args:
+        day (datetime): any time within the UTC day
+        station (string): station identifier
+
+    Returns:
+        list: sorted s3 keys under yyyy/mm/dd/ssss/ssss
+    """
+    client = get_s3_client(aws_access_key_id, aws_secret_access_key)
+    paginator = client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=NEXRAD_BUCKET, Prefix=s3_prefix(day, station)):
+        keys.extend([o['Key'] for o in page.get('Contents', [])])
+    return sorted(keys)
+
+
+def build_station_key_index(
+        start_time,
+        end_time,
+        station,
+        cache_dir=None,
+        aws_access_key_id=None,
+        aws_secret_access_key=None,
+):
+    """Build a sorted index of all scan keys of a station over a date range
+
+    Each UTC station-day prefix is listed once. If cache_dir is given, the keys of UTC days older than
+    KEY_CACHE_MARGIN_DAYS are cached as cache_dir/ssss/yyyy/ssssyyyymmdd.txt so that later runs do not list
+    them again; more recent days may still receive new or late-arriving scans and are never cached.
+
+    Args:
+        start_time (datetime): first time to cover
+        end_time (datetime): last time to cover
+        station (string): station identifier
+        cache_dir (string): directory for the on-disk key cache, no caching if None
+
+    Returns:
+        list: sorted s3 keys, to be passed to get_station_day_scan_keys as key_index
+    """
+    last_cached_day = datetime.utcnow().date() - timedelta(days=KEY_CACHE_MARGIN_DAYS)
+    keys = []
+    current_time = start_time
+    while current_time < end_time + timedelta(days=1):
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(
+                cache_dir, station, '%04d' % current_time.year,
+                '%s%04d%02d%02d.txt' % (station, current_time.year, current_time.month, current_time.day)
+            )
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, 'r') as f:
+                day_keys = [line.strip() for line in f if line.strip()]
+        else:
+            day_keys = list_station_day_keys(
+                current_time, station,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+            )
+            if cache_path is not None and current_time.date() < last_cached_day:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.writelines([f'{key}\n' for key in day_keys])
+                os.replace(tmp_path, cache_path)
+
+        keys.extend(day_keys)
+        current_time = current_time + timedelta(days=1)
+
+    return keys
+
+
 def get_station_day_scan_keys(
         start_time,
         end_time,
@@ -89,51 +252,58 @@ def get_station_day_scan_keys(
         thresh_in_minutes=3,
         aws_access_key_id = None,
         aws_secret_access_key = None,
+        key_index = None,
 ):
+    """Select scans of a station closest to every stride_in_minutes between start_time and end_time
+
+    If key_index (from build_station_key_index, covering start_time to end_time) is given,
+    candidate keys are looked up in it instead of listing the bucket.
+    """
 
-    if aws_access_key_id is None and aws_secret_access_key is None:
-        bucket = boto3.resource('s3', region_name='us-east-2').Bucket('noaa-nexrad-level2')
-    else:
-        bucket = boto3.resource(
-            's3',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name='us-east-2'
-        ).Bucket('noaa-nexrad-level2')
     start_key = s3_key(start_time, station)
     end_key = s3_key(end_time, station)
 
-    keys = []
-    current_time = start_time
-    while current_time < end_time + timedelta(days=1):
-        prefix = s3_prefix(current_time, station)
-        objects = bucket.objects.filter(Prefix=prefix)
-        keys.extend([o.key for o in objects if o.key >= start_key and o.key <= end_key])
-        current_time = current_time + timedelta(days=1)
+    if key_index is not None:
+        keys = key_index[bisect_left(key_index, start_key):bisect_right(key_index, end_key)]
+    else:
+        keys = []
+        current_time = start_time
+        while current_time < end_time + timedelta(days=1):
+            keys.extend([
+                key for key in list_station_day_keys(
+                    current_time, station,
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                ) if start_key <= key <= end_key
+            ])
+            current_time = current_time + timedelta(days=1)
 
     if not keys:
         return []
 
-    # iterate by time and select the appropriate scans
-    times = list(datetime_range(start_time, end_time, timedelta(minutes=stride_in_minutes)))
-    time_thresh = timedelta(minutes=thresh_in_minutes)
-
-    selected_keys = []
-    current_idx = 0
-    for t in times:
-        t_current, _ = parse_key(keys[current_idx])
-
-        while current_idx + 1 < len(keys):
-            t_next, _ = parse_key(keys[current_idx + 1])
-            if abs(t_current - t) < abs(t_next - t):
-                break
-            t_current = t_next
-            current_idx += 1
+    # select the scan closest to each target time; ties go to the later scan.
+    # key times are parsed once and all target times are matched with a single searchsorted
+    key_times = parse_key_times(keys)
+    start_us = to_epoch_us(start_time)
+    stride_us = timedelta(minutes=stride_in_minutes) // timedelta(microseconds=1)
+    thresh_us = timedelta(minutes=thresh_in_minutes) // timedelta(microseconds=1)
+    n_times = (to_epoch_us(end_time) - start_us) // stride_us + 1
+    if n_times <= 0:
+        return []
+    times = start_us + np.arange(n_times, dtype=np.int64) * stride_us
 
-        if abs(t_current - t) <= time_thresh:
-            selected_keys.append(keys[current_idx])
+    after = np.searchsorted(key_times, times, side='right')  # first scan strictly later than each target
+    before = np.maximum(after - 1, 0)
+    after_clipped = np.minimum(after, len(keys) - 1)
+    take_after = (after < len(keys)) & (
+        (after == 0) | (key_times[after_clipped] - times <= times - key_times[before])
+    )
+    # among scans sharing the same timestamp, the last one is selected
+    after_last = np.searchsorted(key_times, key_times[after_clipped], side='right') - 1
+    selected = np.where(take_after, after_last, before)
+    within_thresh = np.abs(key_times[selected] - times) <= thresh_us
 
-    return selected_keys
+    return [keys[idx] for idx in selected[within_thresh]]
 
 
 def download_scan(
@@ -142,19 +312,11 @@ def download_scan(
         aws_access_key_id=None,
         aws_secret_access_key=None,
 ):
-    if aws_access_key_id is None and aws_secret_access_key is None:
-        bucket = boto3.resource('s3', region_name='us-east-2').Bucket('noaa-nexrad-level2')
-    else:
-        bucket = boto3.resource(
-            's3',
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name='us-east-2'
-        ).Bucket('noaa-nexrad-level2')
+    client = get_s3_client(aws_access_key_id, aws_secret_access_key)
 
     local_file = os.path.join(data_dir, key)
     local_dir, filename = os.path.split(local_file)
     os.makedirs(local_dir, exist_ok=True)
 
     if not os.path.isfile(local_file):
-        bucket.download_file(key, local_file)
+        client.download_file(NEXRAD_BUCKET, key, local_file)
@@ -0,0 +1,54 @@
+"""
+Quantize the roost detector to int8 with activation scales calibrated on a few rendered station-days, e.g.
+    python calibrate_detector.py --model_version v3 \
+        --array_dirs ../roosts_data/arrays/2021/07/01/KDOX ../roosts_data/arrays/2021/07/02/KTLX
+The quantized model is used by passing --detector_precision int8 --quantized_detector <output> to demo.py.
+"""
+
+import argparse, glob, os, warnings
+warnings.filterwarnings("ignore")
+
+from roosts.detection.detector import Detector
+from roosts.detection.quantization import calibrate_int8
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_version', type=str, default="v3")
+parser.add_argument('--array_dirs', type=str, nargs="+", required=True,
+                    help="directories of rendered scans, one per station-day")
+parser.add_argument('--output', type=str, default=None,
+                    help="path of the int8 weights, by default next to the checkpoint")
+args = parser.parse_args()
+print(args, flush=True)
+
+if args.model_version == "v2":
+    ckpt_path = f"{here}/../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+elif args.model_version == "v3":
+    ckpt_path = f"{here}/../checkpoints/v3.pth"
+
+# same as the detection model config of demo.py, int8 models run on CPU
+DET_CFG = {
+    "ckpt_path":        ckpt_path,
+    "imsize":           1100 if args.model_version == "v3" else 1200,
+    "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                         [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                         [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                         [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                         [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+    "nms_thresh":       0.3,
+    "score_thresh":     0.05,
+    "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+    "use_gpu":          False,
+    "version":          args.model_version,
+}
+
+array_files_by_day = []
+for array_dir in args.array_dirs:
+    array_files = sorted(glob.glob(os.path.join(array_dir, "*.np[yz]")))
+    array_files_by_day.append([f for f in array_files if not f.endswith(".dualpol.npy")])
+print(f"Calibrating on {sum(len(files) for files in array_files_by_day)} scans", flush=True)
+
+output = args.output or f"{os.path.splitext(ckpt_path)[0]}_int8.pth"
+calibrate_int8(Detector(**DET_CFG), array_files_by_day, output)
+print(f"Saved the int8 {args.model_version} detector to {output}", flush=True)
@@ -1,13 +1,13 @@
 import argparse, time, os, torch, warnings
 import numpy as np
 from datetime import timedelta
-print(f"torch.get_num_threads: {torch.get_num_threads()}", flush=True)
 warnings.filterwarnings("ignore")
 
 from roosts.system import RoostSystem
 from roosts.utils.time_util import get_days_list, get_sun_activity_time
-from roosts.utils.s3_util import get_station_day_scan_keys
+from roosts.utils.s3_util import build_station_key_index, get_station_day_scan_keys
 from roosts.utils.counting_util import get_bird_rcs
+from roosts.utils.cpu_util import parse_cpu_list
 
 here = os.path.dirname(os.path.realpath(__file__))
 
@@ -33,6 +33,46 @@ parser.add_argument('--just_render', action='store_true', help="just download an
 parser.add_argument('--gif_vis', action='store_true', help="generate gif visualization")
 parser.add_argument('--aws_access_key_id', type=str, default=None)
 parser.add_argument('--aws_secret_access_key', type=str, default=None)
+parser.add_argument('--download_workers', type=int, default=1,
+                    help="number of scans downloaded concurrently, 1 for sequential download")
+parser.add_argument('--render_workers', type=int, default=1,
+                    help="number of processes rendering scans in parallel, 1 for rendering in the main process")
+parser.add_argument('--combined_rendering', action='store_true',
+                    help="experimental: map polar to Cartesian once per scan for the array and dualpol array "
+                         "instead of calling radar2mat for each, see development/benchmarks/check_render_parity.py")
+parser.add_argument('--array_format', type=str, default="npz_compressed",
+                    choices=["npz_compressed", "npz_fast", "npz", "npy"],
+                    help="storage format of rendered arrays; npy is uncompressed and memory-mappable")
+parser.add_argument('--array_dtype', type=str, default=None, choices=["float32", "float16"],
+                    help="downcast rendered arrays to save disk space and I/O")
+parser.add_argument('--pipeline', action='store_true',
+                    help="render each scan as soon as it is downloaded instead of after all downloads")
+parser.add_argument('--detector_batch_size', type=int, default=1,
+                    help="number of scans per forward pass of the detector")
+parser.add_argument('--detector_prefetch_depth', type=int, default=0,
+                    help="number of scans prepared ahead of the detector in background threads, 0 to disable")
+parser.add_argument('--detector_prefetch_workers', type=int, default=1,
+                    help="number of threads preparing scans for the detector when prefetching")
+parser.add_argument('--exported_detector', type=str, default=None,
+                    help="TorchScript (.ts) or ONNX (.onnx) detector from tools/export_detector.py to run on CPU")
+parser.add_argument('--detector_precision', type=str, default="fp32", choices=["fp32", "bf16", "int8"],
+                    help="run the detector in reduced precision on CPU, int8 needs --quantized_detector")
+parser.add_argument('--quantized_detector', type=str, default=None,
+                    help="int8 detector weights from tools/calibrate_detector.py")
+parser.add_argument('--torch_threads', type=int, default=0,
+                    help="torch intra-op threads of the detector, 0 for the torch default")
+parser.add_argument('--torch_interop_threads', type=int, default=0,
+                    help="torch inter-op threads of the detector, 0 for the torch default")
+parser.add_argument('--cpu_affinity', type=str, default=None,
+                    help="pin the process to these cpus, e.g. 0-6 or 0,2,4")
+parser.add_argument('--prescreen', action='store_true',
+                    help="skip detection on scans without plausible roost signal, see PRESCREEN_CFG")
+parser.add_argument('--detection_cache', action='store_true',
+                    help="cache detections on disk and reuse them for scans detected with the same model and config")
+parser.add_argument('--inference_server', type=str, default=None,
+                    help="unix socket of a tools/inference_server.py serving the detector, instead of loading it")
+parser.add_argument('--track_assignment', type=str, default="greedy", choices=["greedy", "hungarian"],
+                    help="how the tracker matches tracks to the detections of the next frame")
 args = parser.parse_args()
 assert args.sun_activity in ["sunrise", "sunset"]
 print(args, flush=True)
@@ -57,8 +97,30 @@ DET_CFG = {
     "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
     "use_gpu":          torch.cuda.is_available(),
     "version":          args.model_version,
+    "batch_size":       args.detector_batch_size,
+    "prefetch_depth":   args.detector_prefetch_depth,
+    "prefetch_workers": args.detector_prefetch_workers,
+    "exported_model_path": args.exported_detector,
+    "precision":        args.detector_precision,
+    "quantized_model_path": args.quantized_detector,
+    "num_threads":      args.torch_threads or None,
+    "num_interop_threads": args.torch_interop_threads or None,
+    "cpu_affinity":     parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None,
+    "server_socket":    args.inference_server,
 }
 
+# prescreen config, scans failing it are not passed to the detection model
+PRESCREEN_CFG = {
+    "echo_dbz":             5.,     # pixels above 5dBZ have echoes possibly from animals
+    "min_echo_fraction":    0.001,  # clear air if less than 0.1% of the annulus has echoes
+    "rain_dbz":             35.,
+    "max_rain_fraction":    None,   # roosts can be detected among precipitation, do not skip such scans
+    "r_min":                5000.,  # annulus between 5km and 150km from the radar
+    "r_max":                150000.,
+    "geosize":              300000,
+}
+DET_CFG["prescreen_cfg"] = PRESCREEN_CFG if args.prescreen else None
+
 # postprocessing config
 PP_CFG = {
     "imsize":           600,
@@ -122,34 +184,53 @@ DIRS = {
     "vis_NMS_MERGE_track_dir":    os.path.join(args.data_root, 'vis_NMS_MERGE_tracks'), # vis of tracks after NMS & merge
     "ui_img_dir":                 os.path.join(args.data_root, 'ui', 'img'),
     "scan_and_track_dir":         os.path.join(args.data_root, 'ui', "scans_and_tracks"),
+    "key_index_dir":              os.path.join(args.data_root, 'key_index'), # cached lists of aws keys per station-day
+    "detection_cache_dir":        os.path.join(args.data_root, 'detection_cache'), # cached raw detections per scan
 }
+DET_CFG["cache_dir"] = DIRS["detection_cache_dir"] if args.detection_cache else None
 
 ######################### Run #########################
-roost_system = RoostSystem(args, DET_CFG, PP_CFG, CNT_CFG, DIRS)
-
-days = get_days_list(args.start, args.end)  # timestamps that indicate the beginning of dates, no time zone info
-print("Total number of days: %d" % len(days), flush=True)
-for day_idx, day in enumerate(days):
-    process_start_time = time.time()
+# rendering processes re-import this script, so only the main process runs the system
+if __name__ == "__main__":
+    roost_system = RoostSystem(args, DET_CFG, PP_CFG, CNT_CFG, DIRS)
+    try:
+        days = get_days_list(args.start, args.end)  # timestamps that indicate the beginning of dates, no time zone info
+        print("Total number of days: %d" % len(days), flush=True)
 
-    date_string = day.strftime('%Y%m%d')  # yyyymmdd
-    print(f"-------------------- Day {day_idx+1}: {date_string} --------------------\n", flush=True)
+        # list aws keys for the entire date range once, each station-day prefix is listed at most once and cached
+        key_index = []
+        if len(days) > 0:  # no days if start is after end
+            key_index = build_station_key_index(
+                get_sun_activity_time(args.station, days[0], args.sun_activity) - timedelta(minutes=args.min_before),
+                get_sun_activity_time(args.station, days[-1], args.sun_activity) + timedelta(minutes=args.min_after),
+                args.station,
+                cache_dir=DIRS["key_index_dir"],
+                aws_access_key_id=args.aws_access_key_id,
+                aws_secret_access_key=args.aws_secret_access_key,
+            )
+        for day_idx, day in enumerate(days):
+            process_start_time = time.time()
 
-    sun_activity_time = get_sun_activity_time(
-        args.station,
-        day, # must not have tzinfo
-        args.sun_activity
-    )  # utc timestamp (with utc tzinfo) for the local sun activity after the beginning of the local date
-    start_time = sun_activity_time - timedelta(minutes=args.min_before)
-    end_time = sun_activity_time + timedelta(minutes=args.min_after)
-    keys = get_station_day_scan_keys(
-        start_time,
-        end_time,
-        args.station,
-        aws_access_key_id=args.aws_access_key_id,
-        aws_secret_access_key=args.aws_secret_access_key,
-    )  # aws keys which uses UTC time: yyyy/mm/dd/ssss/ssssyyyymmdd_hhmmss*
-    keys = sorted(list(set(keys)))
+            date_string = day.strftime('%Y%m%d')  # yyyymmdd
+            print(f"-------------------- Day {day_idx+1}: {date_string} --------------------\n", flush=True)
 
-    roost_system.run_day_station(day, sun_activity_time, keys, process_start_time)
+            sun_activity_time = get_sun_activity_time(
+                args.station,
+                day, # must not have tzinfo
+                args.sun_activity
+            )  # utc timestamp (with utc tzinfo) for the local sun activity after the beginning of the local date
+            start_time = sun_activity_time - timedelta(minutes=args.min_before)
+            end_time = sun_activity_time + timedelta(minutes=args.min_after)
+            keys = get_station_day_scan_keys(
+                start_time,
+                end_time,
+                args.station,
+                aws_access_key_id=args.aws_access_key_id,
+                aws_secret_access_key=args.aws_secret_access_key,
+                key_index=key_index,
+            )  # aws keys which uses UTC time: yyyy/mm/dd/ssss/ssssyyyymmdd_hhmmss*
+            keys = sorted(list(set(keys)))
 
+            roost_system.run_day_station(day, sun_activity_time, keys, process_start_time)
+    finally:
+        roost_system.close()
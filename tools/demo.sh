@@ -22,7 +22,8 @@ DST_OTHERS=${16}
 python demo.py \
 --species ${SPECIES} --station ${STATION} --start ${START} --end ${END} \
 --sun_activity ${SUN_ACTIVITY} --min_before ${MIN_BEFORE} --min_after ${MIN_AFTER} \
---data_root ${OUTPUT_ROOT}/${DATASET} --model_version ${MODEL_VERSION} --dataset ${DATASET}
+--data_root ${OUTPUT_ROOT}/${DATASET} --model_version ${MODEL_VERSION} --dataset ${DATASET} \
+--torch_threads ${SLURM_CPUS_PER_TASK:-0}
 
 ##### Transfer outputs. Only transfer the currently processed station-year. #####
 # Transfer outputs for the UI in the verbose mode and with compression
@@ -22,6 +22,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--sun_activity', type=str, default="sunrise", help="time window around sunrise or sunset")
 parser.add_argument('--data_root', type=str, help="directory for all outputs", default=f"{here}/../roosts_data")
 parser.add_argument('--model_version', type=str, default="v2")
+parser.add_argument('--detector_prefetch_depth', type=int, default=0,
+                    help="number of tiff files prepared ahead of the detector in background threads, 0 to disable")
+parser.add_argument('--detector_prefetch_workers', type=int, default=1,
+                    help="number of threads preparing tiff files for the detector when prefetching")
 args = parser.parse_args()
 print(args, flush=True)
 
@@ -40,6 +44,8 @@ DET_CFG = {
     "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
     "use_gpu":          torch.cuda.is_available(),
     "version":          args.model_version,
+    "prefetch_depth":   args.detector_prefetch_depth,
+    "prefetch_workers": args.detector_prefetch_workers,
 }
 
 # tracker model config
@@ -100,6 +106,7 @@ for day in sorted(list(tiff_files_by_day.keys())):
     process_start_time = time.time()
 
     detections = detector.run(tiff_files_by_day[day], file_type="tiff")
+    print(f"Detection waited {detector.input_wait_time:.2f}s for input", flush=True)
     tracked_detections, tracks = tracker.tracking(scans_by_day[day], copy.deepcopy(detections))
     tracks = [t for t in tracks if not t["NMS_suppressed"]]
 
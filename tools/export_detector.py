@@ -0,0 +1,50 @@
+"""
+Export the roost detector to TorchScript or ONNX for CPU inference, e.g.
+    python export_detector.py --model_version v3 --sample_array ../roosts_data/arrays/2021/07/01/KDOX/KDOX20210701_100125_V06.npz
+The exported model is used by passing --exported_detector to demo.py.
+"""
+
+import argparse, os, warnings
+warnings.filterwarnings("ignore")
+
+from roosts.detection.detector import Detector
+from roosts.detection.export import EXPORT_FORMATS, export_detector
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_version', type=str, default="v3")
+parser.add_argument('--format', type=str, default="torchscript", choices=list(EXPORT_FORMATS.keys()))
+parser.add_argument('--sample_array', type=str, required=True,
+                    help="a rendered scan to trace the model with, better with roosts or at least some echoes")
+parser.add_argument('--output', type=str, default=None,
+                    help="path of the exported model, by default next to the checkpoint")
+args = parser.parse_args()
+print(args, flush=True)
+
+if args.model_version == "v2":
+    ckpt_path = f"{here}/../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+elif args.model_version == "v3":
+    ckpt_path = f"{here}/../checkpoints/v3.pth"
+
+# same as the detection model config of demo.py, except that the model is always exported from CPU
+DET_CFG = {
+    "ckpt_path":        ckpt_path,
+    "imsize":           1100 if args.model_version == "v3" else 1200,
+    "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                         [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                         [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                         [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                         [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+    "nms_thresh":       0.3,
+    "score_thresh":     0.05,
+    "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+    "use_gpu":          False,
+    "version":          args.model_version,
+}
+
+output = args.output or f"{os.path.splitext(ckpt_path)[0]}{EXPORT_FORMATS[args.format]}"
+detector = Detector(**DET_CFG)
+_, sample_image, _ = detector._load_input([args.sample_array], 0, "npz")
+export_detector(detector, sample_image, output, export_format=args.format)
+print(f"Exported the {args.model_version} detector to {output}", flush=True)
@@ -0,0 +1,82 @@
+"""
+Serve the roost detector to the demo.py jobs of a node over a unix socket, so that the model is loaded once
+per node and small requests from different stations are batched, e.g.
+    python inference_server.py --model_versions v3 --socket /tmp/$USER/roosts.sock --torch_threads 16
+and run each job with --inference_server /tmp/$USER/roosts.sock. The jobs must use the same model version,
+exported model and precision as one of the served models, which is checked when they connect.
+Only the user running the server can connect: the socket and the random authkey the server writes next to it,
+/tmp/$USER/roosts.sock.key here, are created with mode 0600.
+"""
+
+import argparse, os, warnings
+warnings.filterwarnings("ignore")
+
+from roosts.detection.detector import Detector
+from roosts.detection.server import InferenceServer
+from roosts.utils.cpu_util import parse_cpu_list
+
+here = os.path.dirname(os.path.realpath(__file__))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_versions', type=str, nargs="+", default=["v3"])
+parser.add_argument('--socket', type=str, required=True, help="unix socket to listen on")
+parser.add_argument('--max_batch_size', type=int, default=4,
+                    help="maximum number of scans per forward pass, from any jobs")
+parser.add_argument('--max_wait_ms', type=float, default=50,
+                    help="milliseconds to wait for more scans before running a batch that is not full")
+parser.add_argument('--num_workers', type=int, default=1,
+                    help="number of batches of each model run concurrently")
+parser.add_argument('--use_gpu', action='store_true')
+parser.add_argument('--exported_detector', type=str, default=None,
+                    help="TorchScript or ONNX model from tools/export_detector.py, for a single model version")
+parser.add_argument('--detector_precision', type=str, default="fp32", choices=["fp32", "bf16", "int8"])
+parser.add_argument('--quantized_detector', type=str, default=None,
+                    help="int8 detector weights from tools/calibrate_detector.py, for a single model version")
+parser.add_argument('--torch_threads', type=int, default=0,
+                    help="torch intra-op threads, 0 for the torch default")
+parser.add_argument('--torch_interop_threads', type=int, default=0,
+                    help="torch inter-op threads, 0 for the torch default")
+parser.add_argument('--cpu_affinity', type=str, default=None,
+                    help="pin the server to these cpus, e.g. 0-15 or 0,2,4")
+args = parser.parse_args()
+assert len(args.model_versions) == 1 or (args.exported_detector is None and args.quantized_detector is None), \
+    "exported and quantized detectors are for a single model version"
+print(args, flush=True)
+
+detectors = []
+for model_version in args.model_versions:
+    if model_version == "v2":
+        ckpt_path = f"{here}/../checkpoints/3.2_exp07_resnet101-FPN_detptr_anc10.pth"
+    elif model_version == "v3":
+        ckpt_path = f"{here}/../checkpoints/v3.pth"
+
+    # same as the detection model config of demo.py
+    DET_CFG = {
+        "ckpt_path":        ckpt_path,
+        "imsize":           1100 if model_version == "v3" else 1200,
+        "anchor_sizes":     [[16, 18, 20, 22, 24, 26, 28, 30, 32],
+                             [32, 36, 40, 44, 48, 52, 56, 60, 64],
+                             [64, 72, 80, 88, 96, 104, 112, 120, 128],
+                             [128, 144, 160, 176, 192, 208, 224, 240, 256],
+                             [256, 288, 320, 352, 384, 416, 448, 480, 512]],
+        "nms_thresh":       0.3,
+        "score_thresh":     0.05,
+        "config_file":      "COCO-Detection/faster_rcnn_R_101_FPN_3x.yaml",
+        "use_gpu":          args.use_gpu,
+        "version":          model_version,
+        "exported_model_path": args.exported_detector,
+        "precision":        args.detector_precision,
+        "quantized_model_path": args.quantized_detector,
+        "num_threads":      args.torch_threads or None,
+        "num_interop_threads": args.torch_interop_threads or None,
+        "cpu_affinity":     parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None,
+    }
+    detectors.append(Detector(**DET_CFG))
+    print(f"Loaded the {model_version} detector", flush=True)
+
+InferenceServer(
+    detectors, args.socket,
+    max_batch_size=args.max_batch_size,
+    max_wait=args.max_wait_ms / 1000,
+    num_workers=args.num_workers,
+).serve_forever()
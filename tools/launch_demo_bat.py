@@ -50,9 +50,10 @@ for args in args_list:
     slurm_error = os.path.join(slurm_logs, f"{station}_{start}_{end}.err")
     os.makedirs(slurm_logs, exist_ok=True)
 
-    os.system(f"export MKL_NUM_THREADS={NUM_CPUS}")
-    os.system(f"export OPENBLAS_NUM_THREADS={NUM_CPUS}")
-    os.system(f"export OMP_NUM_THREADS={NUM_CPUS}")
+    # "export" in os.system only affects that subshell; sbatch passes on the environment of this process
+    os.environ["MKL_NUM_THREADS"] = str(NUM_CPUS)
+    os.environ["OPENBLAS_NUM_THREADS"] = str(NUM_CPUS)
+    os.environ["OMP_NUM_THREADS"] = str(NUM_CPUS)
 
     # Now we request cpus via slurm to run the job
     cmd = f'''sbatch \
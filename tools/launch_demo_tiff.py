@@ -11,9 +11,10 @@ slurm_output = os.path.join(slurm_logs, "log.out")
 slurm_error = os.path.join(slurm_logs, "log.err")
 os.makedirs(slurm_logs, exist_ok=True)
 
-os.system(f"export MKL_NUM_THREADS={NUM_CPUS}")
-os.system(f"export OPENBLAS_NUM_THREADS={NUM_CPUS}")
-os.system(f"export OMP_NUM_THREADS={NUM_CPUS}")
+# "export" in os.system only affects that subshell; sbatch passes on the environment of this process
+os.environ["MKL_NUM_THREADS"] = str(NUM_CPUS)
+os.environ["OPENBLAS_NUM_THREADS"] = str(NUM_CPUS)
+os.environ["OMP_NUM_THREADS"] = str(NUM_CPUS)
 
 cmd = f'''sbatch \
 --output="{slurm_output}" \